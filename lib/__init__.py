@@ -3,7 +3,14 @@
 # Created: 2025-06-29
 ###############################################
 
-from lib.pdbmine_query import PDBMineQuery
-from lib.dihedral_adherence import DihedralAdherence
-from lib.multi_window_query import MultiWindowQuery
-from lib.dihedral_adherence_pdb import DihedralAdherencePDB
\ No newline at end of file
+from lib.imports import lazy_attributes
+
+# Classes are imported from their modules on first use, so importing lib (e.g. in worker processes) stays fast
+_lazy_attributes = {
+    'PDBMineQuery': 'lib.pdbmine_query',
+    'DihedralAdherence': 'lib.dihedral_adherence',
+    'MultiWindowQuery': 'lib.multi_window_query',
+    'DihedralAdherencePDB': 'lib.dihedral_adherence_pdb',
+}
+__all__ = list(_lazy_attributes)
+__getattr__ = lazy_attributes(__name__, _lazy_attributes)
\ No newline at end of file
@@ -5,10 +5,11 @@
 
 import numpy as np
 import pandas as pd
-from sklearn.cluster import HDBSCAN
-from scipy.linalg import inv
+from scipy.linalg import cho_solve, solve_triangular
 from lib.utils import get_subseq_func
 
+WINDOW_CLUSTERS_FN = 'window_clusters.npz'
+
 def get_phi_psi_dist_window(q, seq_ctxt):
     seq = q.get_subseq(seq_ctxt)
     phi_psi_dist = q.results_window[q.results_window.seq == seq]
@@ -52,40 +53,146 @@ def get_combined_phi_psi_dist(ins, seq_ctxt, winsizes=None):
     phi_psi_dist_v = phi_psi_dist[[f'phi_{i}' for i in range(smallest_winsize)]+[f'psi_{i}' for i in range(smallest_winsize)]]
     return phi_psi_dist, phi_psi_dist_v
 
+def build_angle_arrays(phi_psi):
+    # Dense phi/psi array of shape (n_models, seq_len, 2) indexed by pos, with a mask of the
+    # (model, pos) rows that exist in phi_psi and a map from seq_ctxt to its unique positions
+    # Models are in sorted protein_id order, as in a pivot over protein_id
+    protein_ids = np.sort(phi_psi.protein_id.unique())
+    seq_len = int(phi_psi.pos.max()) + 1 if phi_psi.shape[0] > 0 else 0
+    model_idx = np.searchsorted(protein_ids, phi_psi.protein_id.values)
+    pos = phi_psi.pos.values.astype(int)
+    angles = np.full((protein_ids.shape[0], seq_len, 2), np.nan)
+    angles[model_idx, pos] = phi_psi[['phi', 'psi']].values
+    present = np.zeros((protein_ids.shape[0], seq_len), dtype=bool)
+    present[model_idx, pos] = True
+    pos_map = phi_psi.groupby('seq_ctxt', sort=False, observed=True).pos.unique().to_dict()
+    return {'df': phi_psi, 'protein_ids': protein_ids, 'angles': angles, 'present': present, 'pos_map': pos_map}
+
+def get_angle_arrays(ins, name):
+    # Angle arrays for 'xray', 'af' or 'pred', rebuilt whenever the underlying DataFrame is replaced
+    phi_psi = getattr(ins, {'xray': 'xray_phi_psi', 'af': 'af_phi_psi', 'pred': 'phi_psi_predictions'}[name], None)
+    if phi_psi is None:
+        return None
+    if name not in ins.angle_arrays or ins.angle_arrays[name]['df'] is not phi_psi:
+        ins.angle_arrays[name] = build_angle_arrays(phi_psi)
+    return ins.angle_arrays[name]
+
+def build_all_angle_arrays(ins):
+    for name in ['xray', 'af', 'pred']:
+        get_angle_arrays(ins, name)
+
+def get_window_slice(pos, center_idx, winsize):
+    # Window of positions around pos, clipped to the start of the sequence like a range filter on pos
+    start = pos - center_idx
+    return slice(max(start, 0), start + winsize), start
+
+def build_match_arrays(q):
+    # Dense (n_matches, winsize, 2) phi/psi array of the windowed matches of one query, with rows
+    # sorted by (seq, match_id) like the pivot in get_combined_phi_psi_dist, and a map from each
+    # subsequence to its (start, end) rows. Missing residues are NaN
+    rw = q.results_window
+    if rw.shape[0] == 0:
+        return np.zeros((0, q.winsize, 2)), {}
+    seq_codes, seqs = pd.factorize(rw.seq)
+    n_ids = int(rw.match_id.max()) + 1
+    keys = seq_codes.astype(np.int64) * n_ids + rw.match_id.values
+    uniq, rows = np.unique(keys, return_inverse=True)
+    matches = np.full((uniq.shape[0], q.winsize, 2), np.nan)
+    matches[rows, rw.window_pos.values] = rw[['phi', 'psi']].values
+    row_seqs = uniq // n_ids
+    starts = np.searchsorted(row_seqs, np.arange(len(seqs)))
+    ends = np.searchsorted(row_seqs, np.arange(len(seqs)), side='right')
+    return matches, {seq: (int(a), int(b)) for seq, a, b in zip(seqs, starts, ends)}
+
+def get_combined_phi_psi_dist_arrays(match_arrays, seq_ctxt, winsize_ctxt, winsizes=None):
+    # Same rows as phi_psi_dist_v from get_combined_phi_psi_dist, built from match arrays
+    # match_arrays: list of (winsize, weight, matches, seq_rows) for each query
+    winsizes = winsizes if winsizes is not None else [m[0] for m in match_arrays]
+    smallest_winsize = min(winsizes)
+    phi_psi_dist = []
+    for winsize, weight, matches, seq_rows in match_arrays:
+        if winsize not in winsizes:
+            continue
+        inner_seq = get_subseq_func(winsize, winsize_ctxt)(seq_ctxt)
+        if inner_seq not in seq_rows:
+            continue
+        start, end = seq_rows[inner_seq]
+        matches_q = np.asarray(matches[start:end])
+        matches_q = matches_q[~np.isnan(matches_q).any(axis=(1,2))]
+        if matches_q.shape[0] == 0:
+            continue
+        # keep only the residues in the smallest window size, as phi_0, ..., psi_0, ...
+        columns = get_subseq_func(smallest_winsize, winsize)(list(range(winsize)))
+        matches_q = matches_q[:, columns].transpose(0,2,1).reshape(matches_q.shape[0], -1)
+        phi_psi_dist.append(np.repeat(matches_q, int(weight), axis=0))
+    if len(phi_psi_dist) == 0:
+        return None
+    return pd.DataFrame(
+        np.concatenate(phi_psi_dist), 
+        columns=[f'phi_{i}' for i in range(smallest_winsize)] + [f'psi_{i}' for i in range(smallest_winsize)]
+    )
+
+def get_window_sample_counts(queries):
+    return [q.results.seq.value_counts() for q in queries]
+
+def get_window_info(queries, seq_counts, seq_ctxt):
+    # Same info as get_phi_psi_dist, from the counts of get_window_sample_counts
+    info = []
+    for q, counts in zip(queries, seq_counts):
+        inner_seq = q.get_subseq(seq_ctxt)
+        info.append((q.winsize, inner_seq, int(counts.get(inner_seq, 0)), q.weight))
+    return info
+
 def get_xrays_window(ins, q, seq_ctxt, return_df=False):
     center_idx = q.get_center_idx_pos()
-    xray_pos = ins.xray_phi_psi[ins.xray_phi_psi.seq_ctxt == seq_ctxt].pos.iloc[0]
-    xrays = ins.xray_phi_psi[(ins.xray_phi_psi.pos >= xray_pos-center_idx) & (ins.xray_phi_psi.pos < xray_pos-center_idx+q.winsize)].copy()
-    xray_point = np.concatenate([xrays['phi'].values, xrays['psi'].values])
     if return_df:
+        xray_pos = ins.xray_phi_psi[ins.xray_phi_psi.seq_ctxt == seq_ctxt].pos.iloc[0]
+        xrays = ins.xray_phi_psi[(ins.xray_phi_psi.pos >= xray_pos-center_idx) & (ins.xray_phi_psi.pos < xray_pos-center_idx+q.winsize)].copy()
+        xray_point = np.concatenate([xrays['phi'].values, xrays['psi'].values])
         return xray_point, xrays
-    return xray_point
+    arrs = get_angle_arrays(ins, 'xray')
+    window, _ = get_window_slice(arrs['pos_map'][seq_ctxt][0], center_idx, q.winsize)
+    xrays = arrs['angles'][0, window][arrs['present'][0, window]]
+    return xrays.T.ravel()
 
 def get_afs_window(ins, q, seq_ctxt, return_df=False):
     center_idx = q.get_center_idx_pos()
-    af_pos = ins.af_phi_psi[ins.af_phi_psi.seq_ctxt == seq_ctxt].pos
-    if len(af_pos) == 0:
-        return None
-    af_pos = af_pos.iloc[0]
-    afs = ins.af_phi_psi[(ins.af_phi_psi.pos >= af_pos-center_idx) & (ins.af_phi_psi.pos < af_pos-center_idx+q.winsize)].copy()
-    af_point = np.concatenate([afs['phi'].values, afs['psi'].values])
     if return_df:
+        af_pos = ins.af_phi_psi[ins.af_phi_psi.seq_ctxt == seq_ctxt].pos
+        if len(af_pos) == 0:
+            return None
+        af_pos = af_pos.iloc[0]
+        afs = ins.af_phi_psi[(ins.af_phi_psi.pos >= af_pos-center_idx) & (ins.af_phi_psi.pos < af_pos-center_idx+q.winsize)].copy()
+        af_point = np.concatenate([afs['phi'].values, afs['psi'].values])
         return af_point, afs
-    return af_point
+    arrs = get_angle_arrays(ins, 'af')
+    if seq_ctxt not in arrs['pos_map']:
+        return None
+    window, _ = get_window_slice(arrs['pos_map'][seq_ctxt][0], center_idx, q.winsize)
+    afs = arrs['angles'][0, window][arrs['present'][0, window]]
+    return afs.T.ravel()
 
 def get_preds_window(ins, q, seq_ctxt):
     center_idx = q.get_center_idx_pos()
-    pred_pos = ins.phi_psi_predictions[ins.phi_psi_predictions.seq_ctxt == seq_ctxt].pos.unique()
-    if len(pred_pos) == 0:
+    arrs = get_angle_arrays(ins, 'pred')
+    pred_pos = arrs['pos_map'].get(seq_ctxt)
+    if pred_pos is None:
         return None
     if len(pred_pos) > 1:
         print(f"Multiple predictions for {seq_ctxt}")
         raise ValueError
-    pred_pos = pred_pos[0]
-    preds = ins.phi_psi_predictions[(ins.phi_psi_predictions.pos >= pred_pos-center_idx) & (ins.phi_psi_predictions.pos < pred_pos-center_idx+q.winsize)].copy()
-    preds = preds[['protein_id', 'pos', 'phi', 'psi']].pivot(index='protein_id', columns='pos', values=['phi', 'psi'])
-    preds.columns = [f'{c[0]}_{c[1]-pred_pos+center_idx}' for c in preds.columns.to_flat_index()]
-    preds = preds.dropna(axis=0)
+    window, start = get_window_slice(pred_pos[0], center_idx, q.winsize)
+    # keep positions present in any model, then only models complete over those positions
+    present = arrs['present'][:, window]
+    cols = present.any(axis=0)
+    preds = arrs['angles'][:, window][:, cols]
+    keep = present[:, cols].all(axis=1) & ~np.isnan(preds).any(axis=(1,2))
+    offsets = np.arange(window.start, window.start + cols.shape[0])[cols] - start
+    preds = pd.DataFrame(
+        preds[keep].transpose(0,2,1).reshape(keep.sum(), 2*cols.sum()),
+        index=pd.Index(arrs['protein_ids'][keep], name='protein_id'),
+        columns=[f'phi_{o}' for o in offsets] + [f'psi_{o}' for o in offsets]
+    )
     return preds
 
 def precompute_dists(phi_psi_dist):
@@ -96,6 +203,7 @@ def precompute_dists(phi_psi_dist):
     return precomputed_dists
 
 def find_clusters(precomputed_dists, min_cluster_size=20, cluster_selection_epsilon=30):
+    from sklearn.cluster import HDBSCAN
     precomputed_dists = precomputed_dists.copy()
     # phi_psi_dist['cluster'] = HDBSCAN(min_cluster_size=20, min_samples=5, metric='precomputed').fit(precomputed_dists).labels_
     clusters = HDBSCAN(
@@ -122,17 +230,117 @@ def calc_da_for_one_window(xrays, target, icov):
 
 def calc_da_window(preds, target, icov):
     preds_diff = diff(preds.values, target)
-    preds_da = np.sqrt((preds_diff @ icov @ preds_diff.T).diagonal())
+    preds_da = np.sqrt(np.einsum('mi,ij,mj->m', preds_diff, icov, preds_diff))
     return preds_da
 
+def calc_da_window_batch(points, targets, chols):
+    # Mahalanobis distance of points (R x M x d) to targets (R x d) for R residues at once,
+    # using the Cholesky factors (R x d x d) of each residue's cluster covariance
+    # Rows of NaN (padding for residues with fewer points) come out as NaN
+    # z = L^-1 diff by forward substitution, without forming the inverse
+    diffs = diff(points, targets[:,np.newaxis])
+    z = np.stack([
+        solve_triangular(chol, d.T, lower=True, check_finite=False) for chol,d in zip(chols, diffs)
+    ]) if chols.shape[0] > 0 else np.zeros((0, chols.shape[-1], diffs.shape[1]))
+    return np.sqrt((z**2).sum(axis=1))
+
+def get_cluster_medoids(phi_psi_dist, precomputed_dists, clusters):
+    # Medoid and size of every cluster, sorted by cluster label
+    # Points are sorted by cluster so each cluster is a contiguous block, then one O(n^2) pass of
+    # np.add.reduceat over the permuted distance matrix gives each point's summed distance to every cluster
+    X = phi_psi_dist.values if hasattr(phi_psi_dist, 'values') else np.asarray(phi_psi_dist)
+    labels, inverse, counts = np.unique(clusters, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    inverse = inverse[order]
+    starts = np.searchsorted(inverse, np.arange(labels.shape[0]))
+    sums = np.add.reduceat(precomputed_dists[np.ix_(order, order)], starts, axis=1)
+    costs = sums[np.arange(X.shape[0]), inverse]
+    # sort by cluster then cost (stable, so ties resolve to the first point like argmin)
+    best = np.lexsort((costs, inverse))[starts]
+    return labels, X[order[best]], counts
+
 def get_target_cluster_icov(phi_psi_dist, precomputed_dists, clusters, af):
     target_cluster = get_target_cluster(phi_psi_dist, clusters, af)
-    cluster_medoid = get_cluster_medoid(phi_psi_dist, precomputed_dists, clusters, target_cluster)
+    labels, medoids, _ = get_cluster_medoids(phi_psi_dist, precomputed_dists, clusters)
+    cluster_medoid = medoids[np.searchsorted(labels, target_cluster)]
     icov = estimate_icov(phi_psi_dist[clusters == target_cluster], cluster_medoid)
     if icov is None:
         return None, None, None
     return target_cluster, cluster_medoid, icov
 
+def get_target_cluster_chol(phi_psi_dist, clusters, af, cluster_ids, medoids):
+    # Same as get_target_cluster_icov, but takes the medoids from get_cluster_medoids
+    # and returns the Cholesky factor of the covariance
+    target_cluster = get_target_cluster(phi_psi_dist, clusters, af)
+    cluster_medoid = medoids[np.searchsorted(cluster_ids, target_cluster)]
+    chol = estimate_cov_chol(phi_psi_dist[clusters == target_cluster], cluster_medoid)
+    if chol is None:
+        return None, None, None
+    return target_cluster, cluster_medoid, chol
+
+
+def save_window_clusters(fn, residues, min_cluster_size, cluster_selection_epsilon, weights):
+    # Persist the clustering of every residue from window-mode DA in one compressed file
+    # residues: list of dicts with keys seq_ctxt, labels (for every row of get_combined_phi_psi_dist,
+    # -1 for noise), cluster_ids, medoids, cluster_counts, target_cluster, icov, n_samples
+    # Per-residue arrays are concatenated, with offsets to slice them back out
+    d = residues[0]['medoids'].shape[1] if len(residues) > 0 else 0
+    label_offsets = np.cumsum([0] + [len(r['labels']) for r in residues])
+    cluster_offsets = np.cumsum([0] + [len(r['cluster_ids']) for r in residues])
+    np.savez_compressed(
+        fn,
+        seqs=np.array([r['seq_ctxt'] for r in residues], dtype=str),
+        label_offsets=label_offsets,
+        labels=np.concatenate([r['labels'] for r in residues] or [[]]).astype(np.int16),
+        cluster_offsets=cluster_offsets,
+        cluster_ids=np.concatenate([r['cluster_ids'] for r in residues] or [[]]).astype(np.int16),
+        medoids=np.concatenate([r['medoids'] for r in residues] or [np.zeros((0, d))]).astype(np.float32),
+        cluster_counts=np.concatenate([r['cluster_counts'] for r in residues] or [[]]).astype(np.int32),
+        target_cluster=np.array([r['target_cluster'] for r in residues], dtype=np.int16),
+        icov=np.array([r['icov'] for r in residues]).reshape(len(residues), d, d),
+        n_samples=np.array([r['n_samples'] for r in residues], dtype=np.int32),
+        min_cluster_size=min_cluster_size,
+        cluster_selection_epsilon=cluster_selection_epsilon,
+        weights=np.array(weights),
+    )
+
+def load_window_clusters(fn):
+    store = np.load(fn)
+    lo, co = store['label_offsets'], store['cluster_offsets']
+    labels, cluster_ids, medoids, cluster_counts = store['labels'], store['cluster_ids'], store['medoids'], store['cluster_counts']
+    target_cluster, icov, n_samples = store['target_cluster'], store['icov'], store['n_samples']
+    residues = {}
+    for k,seq_ctxt in enumerate(store['seqs']):
+        residues[str(seq_ctxt)] = {
+            'labels': labels[lo[k]:lo[k+1]],
+            'cluster_ids': cluster_ids[co[k]:co[k+1]],
+            'medoids': medoids[co[k]:co[k+1]],
+            'cluster_counts': cluster_counts[co[k]:co[k+1]],
+            'target_cluster': target_cluster[k],
+            'icov': icov[k],
+            'n_samples': n_samples[k],
+        }
+    return {
+        'min_cluster_size': int(store['min_cluster_size']),
+        'cluster_selection_epsilon': float(store['cluster_selection_epsilon']),
+        'weights': store['weights'].tolist(),
+        'residues': residues,
+    }
+
+def get_window_clusters(ins, seq_ctxt, min_cluster_size=20, cluster_selection_epsilon=30):
+    # Stored clustering of seq_ctxt from window-mode DA, or None if it was not computed
+    # with the same clustering parameters and window weights
+    if ins.window_clusters is None:
+        fn = ins.outdir / WINDOW_CLUSTERS_FN
+        if not fn.exists():
+            return None
+        ins.window_clusters = load_window_clusters(fn)
+    store = ins.window_clusters
+    if (store['min_cluster_size'] != min_cluster_size or 
+        store['cluster_selection_epsilon'] != cluster_selection_epsilon or
+        store['weights'] != [q.weight for q in ins.queries]):
+        return None
+    return store['residues'].get(seq_ctxt)
 
 # Internally used
 
@@ -140,6 +348,9 @@ def diff(x1, x2):
     d = np.abs(x1 - x2)
     return np.minimum(d, 360-d)
 
+def pairwise_dists(X):
+    return np.linalg.norm(diff(X[:,np.newaxis], X), axis=2)
+
 def get_target_cluster(phi_psi_dist, clusters, point):
     d = np.linalg.norm(diff(point[np.newaxis,:], phi_psi_dist.values), axis=1)
     d = pd.DataFrame({'d': d, 'c': clusters})
@@ -150,12 +361,12 @@ def get_cluster_medoid(phi_psi_dist, precomputed_dists, clusters, c):
     d = precomputed_dists[clusters == c][:,clusters == c]
     return phi_psi_dist[clusters == c].iloc[d.sum(axis=1).argmin()].values
 
-def estimate_icov(phi_psi_dist_c, cluster_medoid):
-    # estimate covariance matrix
+def estimate_cov_chol(phi_psi_dist_c, cluster_medoid):
+    # estimate covariance matrix and return its lower Cholesky factor
     cluster_points = phi_psi_dist_c.values
     diffs = diff(cluster_points, cluster_medoid)
 
-    cov = (diffs[...,np.newaxis] @ diffs[:,np.newaxis]).sum(axis=0) / (diffs.shape[0] - 1)
+    cov = (diffs.T @ diffs) / (diffs.shape[0] - 1)
     cov = cov + np.eye(cov.shape[0]) * 1e-6 # add small value to diagonal to avoid singular matrix
     if np.any(cov <= 0):
         print("Non-positive covariance matrix")
@@ -163,9 +374,16 @@ def estimate_icov(phi_psi_dist_c, cluster_medoid):
     if np.any(cov.diagonal() < 1):
         print("Covariance matrix less than 1")
         return None
-    eigenvalues, eigenvectors = np.linalg.eig(cov)
-    if np.any(eigenvalues < 0):
-        print("Negative eigenvalues - non-positive semi-definite covariance matrix")
+    # factorization fails iff the matrix is not positive definite
+    try:
+        chol = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        print("Cholesky failed - non-positive definite covariance matrix")
+        return None
+    return chol
+
+def estimate_icov(phi_psi_dist_c, cluster_medoid):
+    chol = estimate_cov_chol(phi_psi_dist_c, cluster_medoid)
+    if chol is None:
         return None
-    icov = inv(cov)
-    return icov
\ No newline at end of file
+    return cho_solve((chol, True), np.eye(chol.shape[0]))
@@ -0,0 +1,45 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import argparse
+import subprocess
+import sys
+import pandas as pd
+
+# Dependencies that take a second or more to import - only loaded where they are used
+HEAVY_MODULES = ['torch', 'sklearn', 'statsmodels', 'matplotlib', 'seaborn', 'scipy.stats']
+BENCHMARK_MODULES = ['lib', 'lib.modules.compute_structures', 'lib.training_data', 'lib.dihedral_adherence']
+
+def benchmark_import_time(modules=BENCHMARK_MODULES, n_runs=3, budget=None):
+    # Time importing each module in a fresh interpreter (as a spawned worker does), best of n_runs,
+    # and list the heavy dependencies it pulled in; prints a warning for modules over budget seconds
+    code = (
+        'import sys, time; t = time.perf_counter(); import {module}; t = time.perf_counter() - t; '
+        f'print(t); print(",".join([m for m in {HEAVY_MODULES!r} if m in sys.modules]))'
+    )
+    results = []
+    for module in modules:
+        times = []
+        for _ in range(n_runs):
+            out = subprocess.run(
+                [sys.executable, '-c', code.format(module=module)], capture_output=True, text=True, check=True
+            ).stdout.splitlines()
+            times.append(float(out[0]))
+        heavy = out[1] if len(out) > 1 else ''
+        results.append([module, min(times), heavy])
+        if budget is not None and min(times) > budget:
+            print(f'WARNING: importing {module} took {min(times):.2f}s (budget {budget:.2f}s), loaded: {heavy or "-"}')
+    return pd.DataFrame(results, columns=['module', 'seconds', 'heavy_modules'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time importing lib modules in fresh interpreters')
+    parser.add_argument('modules', nargs='*', default=BENCHMARK_MODULES, help='modules to import')
+    parser.add_argument('--runs', type=int, default=3, help='imports per module (the fastest is reported)')
+    parser.add_argument('--budget', type=float, default=None, help='seconds per module - exit with an error if exceeded')
+    args = parser.parse_args()
+    results = benchmark_import_time(args.modules, args.runs, args.budget)
+    print(results.to_string(index=False))
+    if args.budget is not None and (results.seconds > args.budget).any():
+        sys.exit(1)
@@ -4,6 +4,7 @@
 ###############################################
 
 from pathlib import Path
+from functools import cached_property
 import numpy as np
 from lib import PDBMineQuery
 from lib.retrieve_data import (
@@ -12,40 +13,36 @@ from lib.retrieve_data import (
     retrieve_casp_predictions, 
     retrieve_casp_results,
     retrieve_alphafold_prediction,
+    list_predictions,
     get_pdb_code
 )
-from lib.utils import get_seq_funcs, check_alignment, compute_rmsd, get_find_target, test_correlation
+from lib.utils import (
+    get_seq_funcs, check_alignment, compute_rmsd, compute_rmsd_gdt_all, compute_rmsd_segments, scan_split_rmsd,
+    get_find_target, test_correlation
+)
 from lib.modules import (
     get_phi_psi_xray,
     get_phi_psi_predictions,
     get_phi_psi_af,
     seq_filter,
     get_da_for_all_predictions,
+    get_da_for_all_predictions_ml,
     fit_linregr,
     get_da_for_all_predictions_window
 )
-from lib.plotting import (
-    plot_one_dist,
-    plot_one_dist_3d,
-    plot_da_for_seq,
-    plot_res_vs_da,
-    plot_da_vs_gdt,
-    plot_heatmap,
-    plot_da_vs_gdt_simple,
-    plot_res_vs_da_1plot,
-    plot_dist_kde,
-    plot_one_dist_scatter,
-    plot_across_window_clusters,
-    plot_across_window_cluster_medoids
-)
+from lib.across_window_utils import load_window_clusters, build_all_angle_arrays, WINDOW_CLUSTERS_FN
 from lib.constants import AMINO_ACID_CODES, AMINO_ACID_CODES_INV, AMINO_ACID_CODE_NAMES
+from lib.schema import read_table, PREDICTIONS_DTYPES
 import pandas as pd
-import requests
+from lib.http_client import http_get
+from requests.exceptions import RequestException
 import math
 from Bio.PDB import PDBParser
 import warnings
-from scipy.stats import gmean, hmean
-from lib.ml.models import MLPredictor
+from lib.imports import lazy_import
+
+# matplotlib and seaborn are only loaded once something is plotted
+plotting = lazy_import('lib.plotting')
 
 class DihedralAdherence():
     def __init__(
@@ -68,58 +65,110 @@ class DihedralAdherence():
         else:
             self.outdir.mkdir(exist_ok=False, parents=True)
 
-        # Get targetlist and corresponding pdbcode
-        targetlist = retrieve_target_list()
-        self.pdb_code, self.is_domain = get_pdb_code(casp_protein_id, targetlist)
-        self.alphafold_id = f'{casp_protein_id}TS427_1'
-        if self.is_domain:
-            id, domain = casp_protein_id.split('-')
-            self.alphafold_id = f'{id}TS427_1-{domain}'
-        print('Casp ID:', casp_protein_id, '\tPDB:', self.pdb_code)
-
-        # Retrieve results and pdb files for xray and predictions
-        self.results = retrieve_casp_results(casp_protein_id)
-        self.xray_fn, self.sequence = retrieve_pdb_file(self.pdb_code)
-        self.predictions_dir = retrieve_casp_predictions(casp_protein_id, self.is_domain)
-        self.af_fn = retrieve_alphafold_prediction(self.pdb_code)
-
         # Get sequence and sequence context functions
         _, self.get_center, self.get_seq_ctxt = get_seq_funcs(self.winsize_ctxt)
         
         self.xray_phi_psi = None
         self.af_phi_psi = None
         self.phi_psi_predictions = None
+        self.angle_arrays = {}
         self.overlapping_seqs = None
         self.seqs = None
         self.protein_ids = None
         self.grouped_preds = None
         self.grouped_preds_da = None
-        self.model = None
+        self.window_clusters = None
 
         self.bw_method = None
         self.quantile = quantile
         self.kdews = [1] * len(winsizes) if kdews is None else kdews
-
-        self.queries = []
-        for i,winsize in enumerate(self.winsizes):
-            self.queries.append(PDBMineQuery(
-                self.casp_protein_id, self.pdb_code, winsize, self.pdbmine_url,
-                self.sequence, self.kdews[i], self.pdbmine_cache_dir
-            ))
-            self.queries[-1].set_get_subseq(self.winsize_ctxt)
         self.queried = False
 
         self.mode = mode
+        self.ml_lengths = ml_lengths
+        self.weights_file = weights_file
+        self.device = device
         if model is not None:
             self.model = model
-        else:
-            self.model = MLPredictor(ml_lengths, device, weights_file)
-        if self.mode == 'ml':
-            self.model.load_weights()
+            # passed predictors are loaded as the shared ones are (see get_predictor)
+            if self.mode == 'ml':
+                self.model.load_weights()
+                self.model.model.eval()
     
         self.find_target, self.xray_da_fn, self.pred_da_fn = \
             get_find_target(self)
 
+    # Target resources (target list, CASP results, xray, predictions, AlphaFold, ML model) are only
+    # retrieved on first use, so constructing a target to load saved results does no I/O
+    @cached_property
+    def pdb_info(self):
+        targetlist = retrieve_target_list()
+        pdb_code, is_domain = get_pdb_code(self.casp_protein_id, targetlist)
+        print('Casp ID:', self.casp_protein_id, '\tPDB:', pdb_code)
+        return pdb_code, is_domain
+
+    @cached_property
+    def pdb_code(self):
+        return self.pdb_info[0]
+
+    @cached_property
+    def is_domain(self):
+        return self.pdb_info[1]
+
+    @cached_property
+    def alphafold_id(self):
+        if self.is_domain:
+            id, domain = self.casp_protein_id.split('-')
+            return f'{id}TS427_1-{domain}'
+        return f'{self.casp_protein_id}TS427_1'
+
+    @cached_property
+    def results(self):
+        try:
+            return retrieve_casp_results(self.casp_protein_id)
+        except ValueError as e:
+            # computed from the structures in _get_grouped_preds instead
+            print(e)
+            return None
+
+    @cached_property
+    def xray_info(self):
+        return retrieve_pdb_file(self.pdb_code)
+
+    @cached_property
+    def xray_fn(self):
+        return self.xray_info[0]
+
+    @cached_property
+    def sequence(self):
+        return self.xray_info[1]
+
+    @cached_property
+    def predictions_dir(self):
+        return retrieve_casp_predictions(self.casp_protein_id, self.is_domain)
+
+    @cached_property
+    def af_fn(self):
+        return retrieve_alphafold_prediction(self.pdb_code)
+
+    @cached_property
+    def model(self):
+        if self.mode == 'ml':
+            from lib.ml.models import MLPredictor, get_predictor
+            return get_predictor(MLPredictor, self.ml_lengths, self.device, self.weights_file)
+        return None
+
+    @cached_property
+    def queries(self):
+        queries = []
+        for i,winsize in enumerate(self.winsizes):
+            queries.append(PDBMineQuery(
+                self.casp_protein_id, self.pdb_code, winsize, self.pdbmine_url,
+                self.sequence, self.kdews[i], self.pdbmine_cache_dir
+            ))
+            queries[-1].set_get_subseq(self.winsize_ctxt)
+        return queries
+
     def get_sequence(self, start, end, code=1):
         if code == 1:
             return list(self.sequence[start:end])
@@ -143,25 +192,30 @@ class DihedralAdherence():
             pred_fn = self.predictions_dir / pred_id
         else:
             i = i or 0
-            pred_files = list(self.predictions_dir.iterdir())
+            pred_files = list_predictions(self.predictions_dir)
             pred_fn = pred_files[i]
             print('id =', pred_fn.stem)
         check_alignment(self.xray_fn, pred_fn)
 
-    def compute_structures(self, replace=False):
+    def compute_structures(self, replace=False, validate=False, n_jobs=1):
         # TODO: align pos column of predictions with xray_phi_psi using sequence alignment
-        self.xray_phi_psi = get_phi_psi_xray(self, replace)
-        self.phi_psi_predictions = get_phi_psi_predictions(self, replace)
+        self.xray_phi_psi = get_phi_psi_xray(self, replace, validate)
+        self.phi_psi_predictions = get_phi_psi_predictions(self, replace, validate, n_jobs)
         if self.af_fn is not None:
-            self.af_phi_psi = get_phi_psi_af(self, replace)
+            self.af_phi_psi = get_phi_psi_af(self, replace, validate)
 
         if self.queried:
             self.get_results_metadata()
         # filter
         seq_filter(self)
+        build_all_angle_arrays(self)
     
     def test_pdbmine_conn(self):
-        response = requests.get(self.pdbmine_url + f'/v1/api/protein/{self.pdb_code}')
+        try:
+            response = http_get(self.pdbmine_url + f'/v1/api/protein/{self.pdb_code}')
+        except RequestException as e:
+            print('PDBMine Connection:', type(e).__name__)
+            return False
         print('PDBMine Connection:', response.status_code)
         return response.ok
 
@@ -178,7 +232,7 @@ class DihedralAdherence():
         if self.xray_phi_psi is not None:
             self.get_results_metadata()
     
-    def compute_das(self, replace=True, da_scale=None):
+    def compute_das(self, replace=True, da_scale=None, n_jobs=1, kde_method='binned'):
         if self.xray_phi_psi is None or self.phi_psi_predictions is None:
             print('Run compute_structures() or load_results() first')
             return
@@ -186,11 +240,12 @@ class DihedralAdherence():
             da_scale = [math.log2(i)+1 for i in self.kdews]
         
         if self.mode == 'full_window':
-            get_da_for_all_predictions_window(self, replace)
+            get_da_for_all_predictions_window(self, replace, n_jobs)
+        elif self.mode == 'ml':
+            get_da_for_all_predictions_ml(self, replace, da_scale, kde_method=kde_method)
         else:
             # for all other modes
             get_da_for_all_predictions(self, replace, da_scale)
-            # get_da_for_all_predictions_ml(self, replace, da_scale)
         self._get_grouped_preds()
     
     @property
@@ -224,13 +279,14 @@ class DihedralAdherence():
             query.results['weight'] = query.weight
         self.queried = True
         self.xray_phi_psi = pd.read_csv(self.outdir / 'xray_phi_psi.csv')
-        self.phi_psi_predictions = pd.read_csv(self.outdir / 'phi_psi_predictions.csv')
+        self.phi_psi_predictions = read_table(self.outdir / 'phi_psi_predictions.csv', PREDICTIONS_DTYPES)
         if (self.outdir / 'af_phi_psi.csv').exists():
             self.af_phi_psi = pd.read_csv(self.outdir / 'af_phi_psi.csv')
         else:
             print('No AlphaFold phi-psi data found')
         seq_filter(self)
         self.get_results_metadata()
+        build_all_angle_arrays(self)
         
     def load_results_da(self):
         for query in self.queries:
@@ -241,13 +297,16 @@ class DihedralAdherence():
             query.results['weight'] = query.weight
         self.queried = True
         self.xray_phi_psi = pd.read_csv(self.outdir / self.xray_da_fn)
-        self.phi_psi_predictions = pd.read_csv(self.outdir / self.pred_da_fn)
+        self.phi_psi_predictions = read_table(self.outdir / self.pred_da_fn, PREDICTIONS_DTYPES)
+        if self.mode == 'full_window' and (self.outdir / WINDOW_CLUSTERS_FN).exists():
+            self.window_clusters = load_window_clusters(self.outdir / WINDOW_CLUSTERS_FN)
         if (self.outdir / 'af_phi_psi.csv').exists():
             self.af_phi_psi = pd.read_csv(self.outdir / 'af_phi_psi.csv')
         else:
             print('No AlphaFold phi-psi data found')
         seq_filter(self)
         self.get_results_metadata()
+        build_all_angle_arrays(self)
         self._get_grouped_preds()
 
     def get_results_metadata(self):
@@ -285,6 +344,11 @@ class DihedralAdherence():
         print(f'RMSD={rmsd:.3f}')
         return rmsd
     
+    def compute_gdts(self):
+        # RMSD and GDT of every prediction against the xray, as a stand-in for the CASP results table
+        print('Computing RMSD and GDT of all predictions')
+        return compute_rmsd_gdt_all(self.xray_fn, sorted(list_predictions(self.predictions_dir)))
+
     def split_and_compute_rmsd(self, pred_id=None, split=None, print_alignment=True):
         # split should be int, tuple, list of ints or list of tuples
         # if list of tuples, each tuple should be (pos_xray, pos_pred)
@@ -298,44 +362,27 @@ class DihedralAdherence():
         else:
             if not isinstance(split, list):
                 split = [split]
-            split = sorted(split)
-            rmsds = []
-            rmsd_inner = []
-            n = []
-            prev = (0,0)
-            for s in split:
-                if not isinstance(s, tuple):
-                    s = (s,s)
-                if s[0] - prev[0] < 2:
-                    prev = (s[0] + 1, s[1] + 1)
-                    continue
-                if s[1] - prev[1] < 2:
-                    prev = (s[0] + 1, s[1] + 1)
-                    continue
-                rmsd, ni, dist = compute_rmsd(
-                    self.xray_fn, self.predictions_dir / pred_id,
-                    prev[0], s[0], prev[1], s[1],
-                    print_alignment, return_n=True
-                )
-                print(f'\nRMSD({prev[0]}-{s[0]})={rmsd:.3f}\n')
-                prev = (s[0] + 1, s[1] + 1)
-                rmsds.append(rmsd)
-                n.append(ni)
-                rmsd_inner.append(dist)
-            rmsd, ni, dist = compute_rmsd(
-                self.xray_fn, self.predictions_dir / pred_id,
-                prev[0], None, prev[1], None,
-                print_alignment, return_n=True
+            bounds, rmsds, n, rmsd_inner = compute_rmsd_segments(
+                self.xray_fn, self.predictions_dir / pred_id, split, print_alignment
             )
-            print(f'\nRMSD({prev[0]}-end)={rmsd:.3f}\n')
-            rmsds.append(rmsd)
-            n.append(ni)
-            rmsd_inner.append(dist)
+            for (start, end),rmsd in zip(bounds, rmsds):
+                end = 'end' if end[0] == np.inf else end[0]
+                print(f'\nRMSD({start[0]}-{end})={rmsd:.3f}\n')
+            rmsds, n, rmsd_inner = list(rmsds), list(n), list(rmsd_inner)
             print(f'\nTotal RMSD = {"+".join([f"{r:.03f}" for r in rmsds])} = {sum(rmsds):.3f}')
             print(f'Original RMSD={compute_rmsd(self.xray_fn, self.predictions_dir / pred_id, print_alignment=False):.3f}')
             print(f'Computed Total RMSD: {np.sqrt((1/sum(n)) * sum(rmsd_inner))}')
             print(f'Mean RMSD: {np.mean(rmsds):.3f}')
             return rmsds, n, rmsd_inner
+
+    def scan_split_rmsd(self, pred_id=None, min_size=10):
+        # RMSD of the two halves of a prediction for every split point, best (lowest total) first
+        if pred_id is None:
+            pred_id = self.protein_ids[0]
+        results = scan_split_rmsd(self.xray_fn, self.predictions_dir / pred_id, min_size)
+        if results is None:
+            return None
+        return results.sort_values('rmsd_total')
     
     def test_correlation(self):
         if not 'da' in self.phi_psi_predictions.columns:
@@ -346,7 +393,7 @@ class DihedralAdherence():
     def plot_one_dist(self, seq=None, pred_id=None, pred_name=None, axlims=None, bw_method=-1, fn=None):
         seq = seq or self.overlapping_seqs[0]
         pred_id = pred_id or self.protein_ids[0]
-        plot_one_dist(self, seq, pred_id, pred_name, axlims, bw_method, fn)
+        plotting.plot_one_dist(self, seq, pred_id, pred_name, axlims, bw_method, fn)
 
     def plot_one_dist_3d(self, seq=None, i=None, bw_method=-1, fn=None):
         if i is None and seq is None:
@@ -358,7 +405,7 @@ class DihedralAdherence():
             if len(seq) == 0:
                 raise ValueError(f'No sequence found for position {i}')
             seq = seq[0]
-        plot_one_dist_3d(self, seq, bw_method, fn)
+        plotting.plot_one_dist_3d(self, seq, bw_method, fn)
 
     def plot_da_for_seq(self, seq=None, i=None, pred_id=None, pred_name=None, axlims=None, bw_method=None, fn=None, fill=False, scatter=False):
         if i is None and seq is None:
@@ -371,7 +418,7 @@ class DihedralAdherence():
                 raise ValueError(f'No sequence found for position {i}')
             seq = seq[0]
         pred_id = pred_id or self.protein_ids[0]
-        plot_da_for_seq(self, seq, pred_id, pred_name, bw_method, axlims, fn, fill, scatter)
+        plotting.plot_da_for_seq(self, seq, pred_id, pred_name, bw_method, axlims, fn, fill, scatter)
     
     def plot_res_vs_da(self, pred_id=None, pred_name=None, highlight_res=None, limit_quantile=None, legend_loc='upper right', fn=None, text_loc='right'):
         highlight_res = highlight_res or []
@@ -379,7 +426,7 @@ class DihedralAdherence():
             print('No DA data available. Run compute_das() or load_results_da() first')
             return
         protein_id = pred_id or self.protein_ids[0]
-        return plot_res_vs_da(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc)
+        return plotting.plot_res_vs_da(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc)
     
     def plot_res_vs_da_1plot(self, pred_id=None, pred_name=None, highlight_res=None, limit_quantile=None, legend_loc='upper right', fn=None, text_loc='right', rmsds=None):
         highlight_res = highlight_res or []
@@ -387,7 +434,7 @@ class DihedralAdherence():
             print('No DA data available. Run compute_das() or load_results_da() first')
             return
         protein_id = pred_id or self.protein_ids[0]
-        return plot_res_vs_da_1plot(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc, rmsds)
+        return plotting.plot_res_vs_da_1plot(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc, rmsds)
     
     def plot_da_vs_gdt(self, axlims=None, fn=None):
         if not 'da' in self.phi_psi_predictions.columns:
@@ -397,19 +444,19 @@ class DihedralAdherence():
             self.fit_model()
         else:
             print(f'Model R-squared: {self.model.rsquared:.6f}, Adj R-squared: {self.model.rsquared_adj:.6f}, p-value: {self.model.f_pvalue}')
-        plot_da_vs_gdt(self, axlims, fn)
+        plotting.plot_da_vs_gdt(self, axlims, fn)
     
     def plot_da_vs_gdt_simple(self, axlims=None, fn=None):
         if not 'da' in self.phi_psi_predictions.columns:
             print('No DA data available. Run compute_das() or load_results_da() first')
             return
-        plot_da_vs_gdt_simple(self, axlims, fn)
+        plotting.plot_da_vs_gdt_simple(self, axlims, fn)
     
     def plot_heatmap(self, fillna=False, fillna_row=True, fn=None):
         if not 'da' in self.phi_psi_predictions.columns:
             print('No DA data available. Run compute_das() or load_results_da() first')
             return
-        plot_heatmap(self, fillna, fillna_row, fn)
+        plotting.plot_heatmap(self, fillna, fillna_row, fn)
     
     def plot_dist_kde(self, pred_id=None, percentile=None, fn=None):
         if not 'da' in self.phi_psi_predictions.columns:
@@ -417,25 +464,25 @@ class DihedralAdherence():
             return
         protein_id = pred_id or self.protein_ids[0]
         percentile = percentile or 0.95
-        plot_dist_kde(self, protein_id, percentile, fn)
+        plotting.plot_dist_kde(self, protein_id, percentile, fn)
     
     def plot_one_dist_scatter(self, seq=None, fn=None):
         seq = seq or self.overlapping_seqs[0]
-        plot_one_dist_scatter(self, seq, fn)
+        plotting.plot_one_dist_scatter(self, seq, fn)
     
     def plot_across_window_clusters(self, seq=None, plot_xrays=True, plot_afs=True, n_cluster_lines=50):
         center_idx_ctxt = self.queries[-1].get_center_idx_pos()
         winsize_ctxt = self.queries[-1].winsize
         seqs_for_window = self.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
         seq = seq or seqs_for_window[0]
-        plot_across_window_clusters(self, seq, plot_xrays, plot_afs, n_cluster_lines)
+        plotting.plot_across_window_clusters(self, seq, plot_xrays, plot_afs, n_cluster_lines)
     
     def plot_across_window_cluster_medoids(self, seq=None, plot_xrays=False, plot_afs=False, verbose=False, mode_scatter=False):
         center_idx_ctxt = self.queries[-1].get_center_idx_pos()
         winsize_ctxt = self.queries[-1].winsize
         seqs_for_window = self.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
         seq = seq or seqs_for_window[0]
-        plot_across_window_cluster_medoids(self, seq, plot_xrays, plot_afs, verbose, mode_scatter)
+        plotting.plot_across_window_cluster_medoids(self, seq, plot_xrays, plot_afs, verbose, mode_scatter)
     
     def get_id(self, group_id):
         return f'{self.casp_protein_id}TS{group_id}'
@@ -447,8 +494,10 @@ class DihedralAdherence():
 
         # agg = lambda g: (g.da * g.conf).sum() / g.conf.sum()
         # self.grouped_preds = self.phi_psi_predictions.groupby('protein_id').apply(agg, include_groups=False).to_frame('da')
-        self.grouped_preds = self.phi_psi_predictions.groupby('protein_id').da.mean().to_frame('da')
-        self.grouped_preds['da_na'] = self.phi_psi_predictions[['protein_id', 'da_na']].groupby('protein_id').mean()
+        self.grouped_preds = self.phi_psi_predictions.groupby('protein_id', observed=True).da.mean().to_frame('da')
+        self.grouped_preds['da_na'] = self.phi_psi_predictions[['protein_id', 'da_na']].groupby('protein_id', observed=True).mean()
+        if self.results is None:
+            self.results = self.compute_gdts()
         self.grouped_preds = pd.merge(
             self.grouped_preds.reset_index(),
             self.results[['Model', 'GDT_TS']],
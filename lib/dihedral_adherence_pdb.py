@@ -6,19 +6,20 @@
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from functools import cached_property
 from lib import MultiWindowQuery
 from lib.utils import get_find_target, compute_rmsd, compute_gdt
 from lib.modules import (
-    get_da_for_all_predictions, get_da_for_all_predictions_window, get_da_for_all_predictions_window_ml
+    get_da_for_all_predictions, get_da_for_all_predictions_ml, get_da_for_all_predictions_window,
+    get_da_for_all_predictions_window_ml
 )
-from lib.plotting import (
-    plot_res_vs_da,
-    plot_across_window_clusters,
-    plot_across_window_cluster_medoids
-)
-from lib.ml.models import MLPredictor, MLPredictorWindow
+from lib.across_window_utils import load_window_clusters, build_all_angle_arrays, WINDOW_CLUSTERS_FN
+from lib.imports import lazy_import
+from lib.schema import apply_schema, read_table, PREDICTIONS_DTYPES
 import math
 
+plotting = lazy_import('lib.plotting')
+
 class DihedralAdherencePDB(MultiWindowQuery):
     def __init__(
             self, pdb_code, winsizes, pdbmine_url, 
@@ -28,39 +29,44 @@ class DihedralAdherencePDB(MultiWindowQuery):
             pdbmine_cache_dir='casp_cache',
         ):
         super().__init__(pdb_code, winsizes, pdbmine_url, projects_dir, pdbmine_cache_dir, match_outdir=pdbmine_cache_dir)
-        self.has_af = True
-        if self.af_fn is None:
-            self.has_af = False
-            return
-        self.pred_fn = self.af_fn
+        self.window_clusters = None
         self.phi_psi_predictions = None
         self.overlapping_seqs = None
-        self.model = None
         
         self.bw_method = None
         self.quantile = quantile
         self.kdews = [1] * len(winsizes) if kdews is None else kdews
         
         self.mode = mode
+        self.ml_lengths = [0,0,0,2] if self.mode == 'full_window_ml' else ml_lengths
+        self.weights_file = weights_file
+        self.device = device
         # if model is not None:
             # self.model = model
-        if self.mode == 'ml':
-            self.model = MLPredictor(ml_lengths, device, weights_file)
-            self.model.load_weights()
-        elif self.mode == 'full_window_ml':
-            self.ml_lengths = [0,0,0,2]
-            self.model = MLPredictorWindow(device, self.ml_lengths, self.winsizes, weights_file)
-            self.model.load_weights()
     
         self.find_target, self.xray_da_fn, self.pred_da_fn = \
             get_find_target(self)
-        
-        for w,q in zip(self.kdews, self.queries):
-            q.weight = w
 
         self.results=pd.DataFrame([[self.pdb_code, np.nan, np.nan, np.nan]], columns=['Model', 'GDT_TS', 'RMS_CA', 'DA'])
+
+    @property
+    def has_af(self):
+        return self.af_fn is not None
+
+    @property
+    def pred_fn(self):
+        return self.af_fn
+
+    @cached_property
+    def model(self):
+        from lib.ml.models import MLPredictor, MLPredictorWindow, get_predictor
+        if self.mode == 'ml':
+            return get_predictor(MLPredictor, self.ml_lengths, self.device, self.weights_file)
+        elif self.mode == 'full_window_ml':
+            return get_predictor(MLPredictorWindow, self.ml_lengths, self.device, self.weights_file, self.winsizes)
+        return None
         
-    def compute_das(self, replace=True, da_scale=None):
+    def compute_das(self, replace=True, da_scale=None, n_jobs=1, batch_size=256, kde_method='binned'):
         if self.xray_phi_psi is None or self.phi_psi_predictions is None:
             print('Run compute_structures() or load_results() first')
             return
@@ -69,22 +75,25 @@ class DihedralAdherencePDB(MultiWindowQuery):
             da_scale = [1] * len(self.kdews)
         
         if self.mode == 'full_window':
-            get_da_for_all_predictions_window(self, replace)
+            get_da_for_all_predictions_window(self, replace, n_jobs)
         elif self.mode == 'full_window_ml':
-            get_da_for_all_predictions_window_ml(self, replace)
+            get_da_for_all_predictions_window_ml(self, replace, n_jobs, batch_size)
+        elif self.mode == 'ml':
+            get_da_for_all_predictions_ml(self, replace, da_scale, kde_method=kde_method)
         else:
             # for all other modes
             get_da_for_all_predictions(self, replace, da_scale)
         self.get_total_da()
             
-    def compute_structures(self, replace=False):
-        super().compute_structure(replace)
+    def compute_structures(self, replace=False, validate=False):
+        super().compute_structure(replace, validate)
         # For now, only prediction is alphafold
         if self.af_phi_psi is not None:
-            self.phi_psi_predictions = self.af_phi_psi.drop('conf', axis=1).copy()
+            self.phi_psi_predictions = apply_schema(self.af_phi_psi.drop('conf', axis=1), PREDICTIONS_DTYPES)
         self.phi_psi_predictions.to_csv(self.outdir / 'phi_psi_predictions.csv', index=False)
         if self.queried:
             self.get_results_metadata()
+        build_all_angle_arrays(self)
     
     def query_pdbmine(self, replace=False):
         super().query_pdbmine(replace)
@@ -108,11 +117,12 @@ class DihedralAdherencePDB(MultiWindowQuery):
             print('No AlphaFold phi-psi data found')
             return False
         if (self.outdir / 'phi_psi_predictions.csv').exists():
-            self.phi_psi_predictions = pd.read_csv(self.outdir / 'phi_psi_predictions.csv')
+            self.phi_psi_predictions = read_table(self.outdir / 'phi_psi_predictions.csv', PREDICTIONS_DTYPES)
         else:
-            self.phi_psi_predictions = self.af_phi_psi.drop('conf', axis=1).copy()
+            self.phi_psi_predictions = apply_schema(self.af_phi_psi.drop('conf', axis=1), PREDICTIONS_DTYPES)
         self.seq_filter()
         self.get_results_metadata()
+        build_all_angle_arrays(self)
         return True
         
     def load_results_da(self):
@@ -124,13 +134,16 @@ class DihedralAdherencePDB(MultiWindowQuery):
             query.results['weight'] = query.weight
         self.queried = True
         self.xray_phi_psi = pd.read_csv(self.outdir / self.xray_da_fn)
-        self.phi_psi_predictions = pd.read_csv(self.outdir / self.pred_da_fn)
+        self.phi_psi_predictions = read_table(self.outdir / self.pred_da_fn, PREDICTIONS_DTYPES)
+        if self.mode == 'full_window' and (self.outdir / WINDOW_CLUSTERS_FN).exists():
+            self.window_clusters = load_window_clusters(self.outdir / WINDOW_CLUSTERS_FN)
         if (self.outdir / 'af_phi_psi.csv').exists():
             self.af_phi_psi = pd.read_csv(self.outdir / 'af_phi_psi.csv')
         else:
             print('No AlphaFold phi-psi data found')
         self.seq_filter()
         self.get_results_metadata()
+        build_all_angle_arrays(self)
         self.get_total_da()
 
     def get_results_metadata(self):
@@ -155,7 +168,7 @@ class DihedralAdherencePDB(MultiWindowQuery):
         return self.overlapping_seqs, self.seqs, self.protein_ids
 
     def get_total_da(self):
-        da = self.phi_psi_predictions.groupby('protein_id').da.mean()
+        da = self.phi_psi_predictions.groupby('protein_id', observed=True).da.mean()
         log_da = np.log10(da)
         self.results.loc[0, 'DA'] = log_da.values[0]
 
@@ -166,18 +179,18 @@ class DihedralAdherencePDB(MultiWindowQuery):
             return
         protein_id = self.protein_ids[0]
         pred_name = 'AlphaFold'
-        return plot_res_vs_da(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc)
+        return plotting.plot_res_vs_da(self, protein_id, pred_name, highlight_res, limit_quantile, legend_loc, fn, text_loc)
     
     def plot_across_window_clusters(self, seq=None, plot_xrays=True, plot_afs=True, n_cluster_lines=50):
         center_idx_ctxt = self.queries[-1].get_center_idx_pos()
         winsize_ctxt = self.queries[-1].winsize
         seqs_for_window = self.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
         seq = seq or seqs_for_window[0]
-        plot_across_window_clusters(self, seq, plot_xrays, plot_afs, n_cluster_lines)
+        plotting.plot_across_window_clusters(self, seq, plot_xrays, plot_afs, n_cluster_lines)
     
     def plot_across_window_cluster_medoids(self, seq=None, plot_xrays=False, plot_afs=False, verbose=False, mode_scatter=False, cse=30, fn=None):
         center_idx_ctxt = self.queries[-1].get_center_idx_pos()
         winsize_ctxt = self.queries[-1].winsize
         seqs_for_window = self.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
         seq = seq or seqs_for_window[0]
-        plot_across_window_cluster_medoids(self, seq, plot_xrays, plot_afs, verbose, mode_scatter, cse, fn)
\ No newline at end of file
+        plotting.plot_across_window_cluster_medoids(self, seq, plot_xrays, plot_afs, verbose, mode_scatter, cse, fn)
\ No newline at end of file
@@ -0,0 +1,86 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import os
+import time
+from urllib.parse import urlsplit
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 60)
+RETRIES = 5
+BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 16
+
+# One session (keep-alive connection pool per host) per process, request metrics per host
+_sessions = {}
+_metrics = {}
+
+def set_http_config(timeout=None, retries=None, backoff=None):
+    global TIMEOUT, RETRIES, BACKOFF
+    TIMEOUT = timeout if timeout is not None else TIMEOUT
+    RETRIES = retries if retries is not None else RETRIES
+    BACKOFF = backoff if backoff is not None else BACKOFF
+    # sessions are rebuilt with the new retry settings
+    _sessions.clear()
+
+def get_session():
+    pid = os.getpid()
+    if pid not in _sessions:
+        # Only idempotent methods (urllib3's default set) are retried after a read error or retry status
+        # A POST (e.g. submitting a pdbmine query) is only retried if it could not connect, so it is never sent twice
+        retry = Retry(
+            total=RETRIES, backoff_factor=BACKOFF, status_forcelist=RETRY_STATUSES, raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[pid] = session
+    return _sessions[pid]
+
+def http_request(method, url, timeout=None, **kwargs):
+    # Request through the pooled session, retrying connection errors and transient statuses with backoff
+    # Failed responses are returned as usual (check response.ok); connection errors raise after the retries
+    metrics = _metrics.setdefault(urlsplit(url).netloc, {
+        'requests': 0, 'failed': 0, 'retries': 0, 'total_time': 0.0, 'max_time': 0.0
+    })
+    start = time.perf_counter()
+    try:
+        response = get_session().request(method, url, timeout=timeout or TIMEOUT, **kwargs)
+    except requests.RequestException:
+        metrics['failed'] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics['requests'] += 1
+        metrics['total_time'] += elapsed
+        metrics['max_time'] = max(metrics['max_time'], elapsed)
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None:
+        metrics['retries'] += len(retries.history)
+    if not response.ok:
+        metrics['failed'] += 1
+    return response
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
+def get_http_metrics():
+    # Requests, failures, retries and latency (seconds, including retries) per host in this process
+    metrics = pd.DataFrame.from_dict(_metrics, orient='index')
+    if len(metrics) > 0:
+        metrics['mean_time'] = metrics['total_time'] / metrics['requests']
+    return metrics
+
+def reset_http_metrics():
+    _metrics.clear()
@@ -0,0 +1,31 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import importlib
+import importlib.util
+import sys
+
+def lazy_import(name):
+    # Module that is only executed on first attribute access
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def lazy_attributes(module_name, attributes):
+    # Module __getattr__ (PEP 562) that imports each attribute from its submodule on first access
+    # attributes maps attribute names to the submodules defining them
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+        value = getattr(importlib.import_module(attributes[name]), name)
+        setattr(sys.modules[module_name], name, value)
+        return value
+    return __getattr__
@@ -3,13 +3,21 @@
 # Created: 2025-06-29
 ###############################################
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, ConcatDataset
 import torch
+import numpy as np
+import json
+import os
 from pathlib import Path
 
+SHARD_INDEX_FN = 'index.json'
+SHARD_ARRAYS = [('X', np.float32), ('xres', np.int64), ('y', np.float32)]
+
 def get_dataset(lengths, path):
     path = Path(path+'-'.join([str(l) for l in lengths]))
-    samples = [f.stem for f in path.iterdir()]
+    if (path / SHARD_INDEX_FN).exists():
+        return ShardedDataset(path)
+    return ConcatDataset([ProteinDataset(f.stem, path) for f in sorted(path.iterdir()) if f.suffix == '.pt'])
 
 class ProteinDataset(Dataset):
     def __init__(self, id, path):
@@ -21,4 +29,179 @@ class ProteinDataset(Dataset):
         return self.X.shape[0]
 
     def __getitem__(self, i):
-        return self.X[i], self.xres[i], self.y[i]
\ No newline at end of file
+        return self.X[i], self.xres[i], self.y[i]
+
+def collate_windows(batch, n_medoids):
+    # DataLoader collate_fn for (X, xres, y) samples whose windows may have different lengths
+    # Pads each window at its end to the longest in the batch and each medoid set to n_medoids, the model's
+    # input width (sum(lengths[1:])) - bind it with functools.partial(collate_windows, n_medoids=...)
+    # Drops samples with no medoids and returns (X, xres, y, key_padding_mask)
+    L = max([xres.shape[0] for _,xres,_ in batch])
+    C = n_medoids
+    if max([X.shape[0] for X,_,_ in batch]) > C:
+        raise ValueError(f'Sample has more than n_medoids={C} medoids')
+    N = len(batch)
+    X_pad = torch.zeros((N, C, 2, L))
+    xres_pad = torch.zeros((N, L), dtype=torch.int64)
+    y_pad = torch.zeros((N, L, 2))
+    mask = torch.ones((N, L), dtype=torch.bool)
+    for i,(X,xres,y) in enumerate(batch):
+        c, l = X.shape[0], xres.shape[0]
+        X_pad[i, :c, :, :l] = X.view(c, 2, l)
+        xres_pad[i, :l] = xres
+        y_pad[i, :l] = y
+        mask[i, :l] = False
+    X_pad = X_pad.view(N, C, 2*L)
+    keep = X_pad.flatten(1).any(dim=1)
+    return X_pad[keep], xres_pad[keep], y_pad[keep], mask[keep]
+
+def load_shard_index(path):
+    with open(Path(path) / SHARD_INDEX_FN) as f:
+        return json.load(f)
+
+def get_shard_fn(path, shard, name):
+    return Path(path) / f'shard{shard:05d}_{name}.npy'
+
+class ShardWriter():
+    # Writes samples (X, xres, y) of many proteins into shards of shard_size samples, one .npy file per array
+    # index.json holds the shard sizes and, for each protein, its (shard, start, count) ranges
+    # Proteins are only listed once all of their samples are on disk; reopening a dataset appends to it
+    def __init__(self, path, shard_size=16384):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.buffer = {name: [] for name,_ in SHARD_ARRAYS}
+        self.n_buffered = 0
+        self.pending = {}
+        # partial last shard being refilled - it keeps its count in the index until it is rewritten
+        self.refill = None
+
+        if (self.path / SHARD_INDEX_FN).exists():
+            self.index = load_shard_index(self.path)
+            # keep filling a partial last shard - it is rewritten under the same number
+            if len(self.index['shards']) > 0 and self.index['shards'][-1] < self.index['shard_size']:
+                self.refill = len(self.index['shards']) - 1
+                for name,_ in SHARD_ARRAYS:
+                    self.buffer[name].append(np.load(get_shard_fn(self.path, self.refill, name)))
+                self.n_buffered = self.index['shards'][-1]
+        else:
+            self.index = {'shard_size': shard_size, 'shards': [], 'proteins': {}, 'skipped': {}}
+        self.shard_size = self.index['shard_size']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_shard(self):
+        return self.refill if self.refill is not None else len(self.index['shards'])
+
+    def done(self, protein_id):
+        return protein_id in self.index['proteins'] or protein_id in self.index['skipped'] or protein_id in self.pending
+
+    def add(self, protein_id, X, xres, y):
+        arrays = {'X': X, 'xres': xres, 'y': y}
+        arrays = {name: np.asarray(arrays[name], dtype=dtype) for name,dtype in SHARD_ARRAYS}
+        n = arrays['X'].shape[0]
+        ranges = []
+        self.pending[protein_id] = ranges
+        start = 0
+        while start < n:
+            k = min(self.shard_size - self.n_buffered, n - start)
+            for name,_ in SHARD_ARRAYS:
+                self.buffer[name].append(arrays[name][start:start+k])
+            ranges.append([self.next_shard(), self.n_buffered, k])
+            self.n_buffered += k
+            start += k
+            if self.n_buffered == self.shard_size:
+                self.write_shard()
+
+    def skip(self, protein_id, reason):
+        # Record a protein that produced no samples, so restarts do not retry it
+        self.index['skipped'][protein_id] = reason
+        self.write_index()
+
+    def write_shard(self):
+        shard = self.next_shard()
+        for name,_ in SHARD_ARRAYS:
+            fn = get_shard_fn(self.path, shard, name)
+            tmp = fn.with_suffix('.tmp.npy')
+            np.save(tmp, np.concatenate(self.buffer[name]))
+            os.replace(tmp, fn)
+            self.buffer[name] = []
+        if self.refill is not None:
+            self.index['shards'][self.refill] = self.n_buffered
+            self.refill = None
+        else:
+            self.index['shards'].append(self.n_buffered)
+        self.n_buffered = 0
+        self.write_index()
+
+    def write_index(self):
+        # index['shards'] only ever holds the counts of the shard files on disk - proteins in the buffer
+        # (including a refilled shard) are listed once their shard is written
+        n_written = self.next_shard()
+        for protein_id,ranges in list(self.pending.items()):
+            if all([r[0] < n_written for r in ranges]):
+                self.index['proteins'][protein_id] = self.pending.pop(protein_id)
+        tmp = self.path / (SHARD_INDEX_FN + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.path / SHARD_INDEX_FN)
+
+    def close(self):
+        # a refilled shard with nothing added is already on disk
+        refilled = self.refill is not None and self.n_buffered > self.index['shards'][self.refill]
+        if refilled or (self.refill is None and self.n_buffered > 0):
+            self.write_shard()
+        else:
+            self.write_index()
+
+class ShardedDataset(Dataset):
+    # Random access to the samples written by ShardWriter, optionally restricted to some proteins
+    # Shards are memory-mapped on first access in each process, so DataLoader workers read only the rows they use
+    def __init__(self, path, protein_ids=None):
+        self.path = Path(path)
+        self.index = load_shard_index(self.path)
+        self.offsets = np.concatenate([[0], np.cumsum(self.index['shards'], dtype=np.int64)])
+        self.samples = None
+        if protein_ids is not None:
+            ranges = [r for protein_id in protein_ids for r in self.index['proteins'][protein_id]]
+            self.samples = np.concatenate(
+                [np.arange(self.offsets[shard] + start, self.offsets[shard] + start + k) for shard,start,k in ranges]
+                + [np.array([], dtype=np.int64)]
+            )
+        self.shards = None
+
+    def __len__(self):
+        return int(self.offsets[-1]) if self.samples is None else self.samples.shape[0]
+
+    def __getstate__(self):
+        # memory maps are reopened in each worker
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def open(self):
+        self.shards = [
+            [np.load(get_shard_fn(self.path, shard, name), mmap_mode='r') for name,_ in SHARD_ARRAYS]
+            for shard in range(len(self.index['shards']))
+        ]
+
+    def __getitem__(self, i):
+        if self.shards is None:
+            self.open()
+        i = i if self.samples is None else self.samples[i]
+        shard = np.searchsorted(self.offsets, i, side='right') - 1
+        row = i - self.offsets[shard]
+        X, xres, y = [torch.from_numpy(np.array(a[row])) for a in self.shards[shard]]
+        return X, xres, y
+
+def convert_protein_files(src, dst, shard_size=16384):
+    # Copy a directory of per-protein .pt files (ProteinDataset layout) into shards
+    with ShardWriter(dst, shard_size) as writer:
+        for f in sorted(Path(src).iterdir()):
+            if f.suffix != '.pt' or writer.done(f.stem):
+                continue
+            X, y, xres = torch.load(f)
+            writer.add(f.stem, X.numpy(), xres.numpy(), y.numpy())
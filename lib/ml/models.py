@@ -3,12 +3,82 @@
 # Created: 2025-06-29
 ###############################################
 
+import copy
 import torch
 from torch import nn
 import torch.nn.functional as F
 from lib.ml.transformer_model import TransformerModel
 from lib.constants import AMINO_ACID_MAP
 
+# Shared predictors, keyed by (class, lengths, winsizes, weights_file, device)
+_predictors = {}
+
+def get_predictor(cls, lengths, device, weights_file, winsizes=None):
+    # Build and load a predictor on first request, then hand out the same eval-mode instance
+    key = (
+        cls, tuple(lengths), None if winsizes is None else tuple(int(w) for w in winsizes),
+        str(weights_file), str(device)
+    )
+    if key not in _predictors:
+        if cls is MLPredictorWindow:
+            predictor = cls(device, lengths, winsizes, weights_file)
+        else:
+            predictor = cls(lengths, device, weights_file)
+        predictor.load_weights()
+        predictor.model.eval()
+        _predictors[key] = predictor
+    return _predictors[key]
+
+def clear_predictors():
+    _predictors.clear()
+
+def set_cpu_threads(n_threads=None, n_interop_threads=None):
+    # Process-wide torch thread pools for CPU inference
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if n_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(n_interop_threads)
+        except RuntimeError:
+            print('Inter-op threads can only be set before any parallel work has run - ignoring')
+
+def export_model(model, sample_inputs, method='trace', quantize=False):
+    # CPU copy of an eval-mode model: eager, traced or scripted, optionally with int8 dynamic quantization of Linear layers
+    model = copy.deepcopy(model).cpu().eval()
+    if hasattr(model, 'device'):
+        model.device = 'cpu'
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        if method == 'eager':
+            return model
+        elif method == 'trace':
+            return torch.jit.freeze(torch.jit.trace(model, sample_inputs))
+        elif method == 'script':
+            return torch.jit.freeze(torch.jit.script(model))
+    raise ValueError(f'Unknown export method {method}')
+
+def export_predictor(predictor, method='trace', quantize=False, n_threads=None, n_interop_threads=None, n_samples=64, atol=None):
+    # Copy of predictor running an exported model on CPU
+    # Returns None if the exported model's outputs on sample inputs differ from the original's by more than atol
+    # (default 1e-3, or 5 degrees when quantized)
+    set_cpu_threads(n_threads, n_interop_threads)
+    if atol is None:
+        atol = 5.0 if quantize else 1e-3
+    inputs = predictor.sample_inputs(n_samples)
+    exported = copy.copy(predictor)
+    exported.device = 'cpu'
+    exported.model = export_model(predictor.model, inputs, method, quantize)
+
+    with torch.no_grad():
+        expected = predictor.model(*[x.to(predictor.device) for x in inputs]).cpu()
+        diff = (exported.model(*inputs) - expected).abs().max().item()
+    print(f'Exported {method}{" int8" if quantize else ""} model - max abs diff from original: {diff:.3g}')
+    if diff > atol:
+        print(f'Parity check failed (atol={atol})')
+        return None
+    return exported
+
 class MLPredictor():
     def __init__(self, lengths, device, weights_file):
         self.model = KDENet().to(device)
@@ -27,11 +97,23 @@ class MLPredictor():
     def load_weights(self):
         self.model.load_state_dict(torch.load(self.weights_file, map_location=self.device))
 
+    def sample_inputs(self, n, seed=0):
+        # Random model inputs (X, xres, af) for n residues
+        g = torch.Generator().manual_seed(seed)
+        X = torch.rand((n, 4, 2), generator=g) * 360 - 180
+        xres = F.one_hot(torch.randint(0, 20, (n,), generator=g), num_classes=20)
+        af = torch.rand((n, 2), generator=g) * 360 - 180
+        return X, xres, af
+
+    def export(self, method='trace', quantize=False, n_threads=None, n_interop_threads=None, n_samples=64, atol=None):
+        return export_predictor(self, method, quantize, n_threads, n_interop_threads, n_samples, atol)
+
 class MLPredictorWindow():
     def __init__(self, device, lengths, winsizes, weights_file):
         self.model = TransformerModel(lengths, winsizes, device).to(device)
         self.model.eval()
         self.lengths = lengths # number of clusters for each window size
+        self.winsizes = winsizes
         self.device = device
         self.weights_file = weights_file
 
@@ -40,6 +122,20 @@ class MLPredictorWindow():
         with torch.no_grad():
             X, xres = torch.tensor(X).float().to(self.device), xres.to(self.device)
             return self.model(X.unsqueeze(0), xres.unsqueeze(0)).cpu()
+
+    def predict_batch(self, X, seqs, batch_size=256):
+        # X is (R, n_medoids, 2*winsize) medoids for R residues, seqs their context sequences
+        # returns (R, winsize, 2), nan for residues with no medoids
+        xres = torch.tensor([[AMINO_ACID_MAP[r] for r in seq] for seq in seqs])
+        X = torch.as_tensor(X, dtype=torch.float32)
+        X_kept, xres, keep = TransformerModel.drop_empty(X, xres)
+        out = torch.full((X.shape[0], xres.shape[1], 2), float('nan'))
+        preds = [torch.empty((0, xres.shape[1], 2))]
+        with torch.inference_mode():
+            for i in range(0, X_kept.shape[0], batch_size):
+                preds.append(self.model(X_kept[i:i+batch_size].to(self.device), xres[i:i+batch_size].to(self.device)).cpu())
+        out[keep] = torch.cat(preds)
+        return out
     
     def __call__(self, X, xres, af):
         return self.predict(X, xres, af)
@@ -47,6 +143,17 @@ class MLPredictorWindow():
     def load_weights(self):
         self.model.load_state_dict(torch.load(self.weights_file, map_location=self.device))
 
+    def sample_inputs(self, n, seed=0):
+        # Random model inputs (medoids, residue indices) for n residues
+        g = torch.Generator().manual_seed(seed)
+        L = int(self.winsizes[-1])
+        X = torch.rand((n, sum(self.lengths[1:]), 2*L), generator=g) * 360 - 180
+        xres = torch.randint(0, 20, (n, L), generator=g)
+        return X, xres
+
+    def export(self, method='trace', quantize=False, n_threads=None, n_interop_threads=None, n_samples=64, atol=None):
+        return export_predictor(self, method, quantize, n_threads, n_interop_threads, n_samples, atol)
+
 class KDENet(nn.Module):
     def __init__(self):
         super().__init__()
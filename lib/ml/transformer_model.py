@@ -6,8 +6,9 @@
 from torch import nn
 import torch
 from torch.nn import functional as F
+from typing import Optional
 
-def get_offset(L):
+def get_offset(L: int) -> int:
     if L % 2 == 0:
         return L // 2 - 1
     return L - L // 2 - 1
@@ -16,8 +17,8 @@ class SelfAttention(nn.Module):
     def __init__(self, d, nhead):
         super().__init__()
         self.mha = nn.MultiheadAttention(d, nhead, batch_first=True)
-    def forward(self, x):
-        return self.mha(x, x, x)[0]
+    def forward(self, x, key_padding_mask: Optional[torch.Tensor] = None):
+        return self.mha(x, x, x, key_padding_mask=key_padding_mask, need_weights=False)[0]
 
 class Block(nn.Module):
     def __init__(self, d, nhead, n=None, dropout=0.0):
@@ -32,8 +33,8 @@ class Block(nn.Module):
             nn.Linear(n, d),
             nn.Dropout(dropout)
         )
-    def forward(self, x):
-        x = x + self.mha(self.ln1(x))
+    def forward(self, x, key_padding_mask: Optional[torch.Tensor] = None):
+        x = x + self.mha(self.ln1(x), key_padding_mask)
         x = x + self.ffwd(self.ln2(x))
         return x
 
@@ -41,7 +42,7 @@ class TransformerModel(nn.Module):
     def __init__(self, x_lens, winsizes, device, n_classes=20):
         super().__init__()
         self.x_lens = x_lens
-        self.winsizes = winsizes
+        self.winsizes = [int(w) for w in winsizes]
         self.n_medoids = sum(x_lens[1:])
         self.af_input_size = sum([w*2 for w in winsizes])
         self.input_size = sum([l*w*2 for l,w in zip(x_lens, winsizes)])
@@ -52,45 +53,50 @@ class TransformerModel(nn.Module):
 
         # self.embs = nn.ModuleList([nn.Linear(w*2, self.d, bias=False) for w in winsizes[1:]])
         n_clusters = 2 # FOR WIN 7 ONLY
-        self.pos_emb = nn.Embedding(winsizes[-1], self.d) # positional embedding for 7 (biggest window size) positions
+        self.pos_emb = nn.Embedding(self.winsizes[-1], self.d) # positional embedding for 7 (biggest window size) positions
         self.emb = nn.Linear(n_classes + 2*n_clusters, self.d)
         
         dropout = 0.15
         nlinear = self.d
-        self.blocks = nn.Sequential(
+        self.blocks = nn.ModuleList([
             Block(self.d, nheads, nlinear, dropout),
             # Block(self.d, nheads, nlinear, dropout),
             # Block(self.d, nheads, nlinear, dropout),
             # Block(self.d, nheads, nlinear, dropout)
-        )
+        ])
 
         self.ln_f = nn.LayerNorm(self.d)
         self.out = nn.Linear(self.d, 2)
 
-    def emb_mask(self, x_medoids):
-        xs = [[] for _ in range(x_medoids[0].shape[0])] # batch size
-        for i,x in enumerate(x_medoids[1:]):
-            mask = torch.any(x, dim=2)
-            for j,xi in enumerate(x):
-                xs[j].append(self.embs[i](xi[mask[j]]))
-        return torch.nested.nested_tensor([torch.cat(xi, dim=0) for xi in xs])
+    @staticmethod
+    def drop_empty(x_medoids, *xs):
+        # Remove examples with no medoids (all zeros), returning the kept tensors and the keep mask
+        keep = x_medoids.flatten(1).any(dim=1)
+        return (x_medoids[keep], *[x[keep] for x in xs], keep)
 
-    def forward(self, x_medoids, x_res):
-        # x = torch.cat([self.embs[i](x[:,:1]) for i,x in enumerate(x_medoids[1:])], dim=1) # one cluster for each window
-        # x = torch.cat([self.embs[i](x) for i,x in enumerate(x_medoids[1:])], dim=1)
-        # TODO remove examples in batch with all zeros in x_medoids (no clusters)
+    def forward(self, x_medoids, x_res, key_padding_mask: Optional[torch.Tensor] = None):
+        # x_medoids (N, C, 2L): C medoids (zero rows if fewer clusters), phi then psi for each window position
+        # x_res (N, L) residue indices
+        # key_padding_mask (N, L): True at positions padding a window shorter than L (at its end), which attention ignores
         N, C, L = x_medoids.shape
         L = L // 2
         x_res = nn.functional.one_hot(x_res, num_classes=20)
         x_medoids = x_medoids.transpose(-2,-1).view(N, 2, L, C).transpose(-3,-2).flatten(-2,-1)
         x = torch.cat([x_res, x_medoids], dim=-1)
 
-        pos = (torch.arange(L) + get_offset(self.winsizes[-1]) - get_offset(L)).to(self.device)
+        # positions relative to the center of the largest window, for each example's own window length
+        if key_padding_mask is None:
+            pos = (torch.arange(L) + get_offset(self.winsizes[-1]) - get_offset(L)).to(self.device)
+        else:
+            lengths = (~key_padding_mask).sum(dim=1, keepdim=True)
+            pos = torch.arange(L, device=x.device).unsqueeze(0) + get_offset(self.winsizes[-1]) - (lengths - 1) // 2
+            pos = pos.clamp(0, self.winsizes[-1] - 1)
         pos = self.pos_emb(pos)
         
         x = self.emb(x) + pos
         
-        x = self.blocks(x)
+        for block in self.blocks:
+            x = block(x, key_padding_mask)
         x = self.out(x)
         return x
     
@@ -106,11 +112,13 @@ class TransformerModel(nn.Module):
 class AngleMSELoss(nn.Module):
     def __init__(self):
         super().__init__()
-    def forward(self, x, y, reduce='mean'):
+    def forward(self, x, y, reduce='mean', key_padding_mask=None):
         def diff(x1, x2):
             d = torch.abs(x1 - x2)
             d = torch.minimum(d, 360-d)
             return d
+        if key_padding_mask is not None:
+            x, y = x[~key_padding_mask], y[~key_padding_mask]
         if reduce=='sum':
             return torch.sum(diff(x, y)**2)
         return torch.mean(diff(x, y)**2)
\ No newline at end of file
@@ -9,6 +9,7 @@ import torch.nn.functional as F
 from lib.constants import AMINO_ACID_MAP
 import numpy as np
 import pandas as pd
+import time
 
 def save_model(model, path):
     if type(model) == nn.DataParallel:
@@ -20,6 +21,24 @@ def load_model(model, path):
     model.load_state_dict(torch.load(path))
     return model
 
+def benchmark_predictors(predictors, batch_sizes=[1, 64, 256], n_iters=20, n_warmup=3):
+    # Latency and throughput of each predictor's model on sample inputs
+    # predictors: dict of name -> predictor, eg {'eager': p, 'int8': p.export(quantize=True)}
+    rows = []
+    for name, predictor in predictors.items():
+        for batch_size in batch_sizes:
+            inputs = [x.to(predictor.device) for x in predictor.sample_inputs(batch_size)]
+            times = []
+            with torch.inference_mode():
+                for i in range(n_warmup + n_iters):
+                    start = time.perf_counter()
+                    predictor.model(*inputs)
+                    if i >= n_warmup:
+                        times.append(time.perf_counter() - start)
+            latency = np.median(times)
+            rows.append([name, batch_size, latency * 1000, batch_size / latency])
+    return pd.DataFrame(rows, columns=['variant', 'batch_size', 'latency_ms', 'throughput'])
+
 def get_ml_pred(peaks, res, af, ml):
     xres = AMINO_ACID_MAP[res]
     xres = F.one_hot(torch.tensor(xres, dtype=torch.int64), num_classes=20).unsqueeze(0)
@@ -28,6 +47,14 @@ def get_ml_pred(peaks, res, af, ml):
     pred = ml(X, xres, af).squeeze().numpy()
     return pred
 
+def get_ml_preds(peaks, res, af, ml):
+    # get_ml_pred for many residues in one forward pass
+    # peaks (R, n_winsizes, 2), res the R center residues, af (R, 2)
+    xres = F.one_hot(torch.tensor([AMINO_ACID_MAP[r] for r in res], dtype=torch.int64), num_classes=20)
+    X = torch.tensor(peaks, dtype=torch.float32)
+    af = torch.tensor(af, dtype=torch.float32)
+    return ml(X, xres, af).numpy()
+
 # def get_ml_pred(phi_psi_dist, winsizes, res, af, ml):
 #     phis = []
 #     psis = []
@@ -3,9 +3,19 @@
 # Created: 2025-06-29
 ###############################################
 
-from lib.modules.compute_structures import get_phi_psi_xray, get_phi_psi_predictions, seq_filter, get_phi_psi_af
-from lib.modules.query_pdbmine import query_and_process_pdbmine
-from lib.modules.compute_das import get_da_for_all_predictions
-from lib.modules.fit_model import fit_linregr
-from lib.modules.compute_das_window import get_da_for_all_predictions_window
-from lib.modules.compute_das_window_ml import get_da_for_all_predictions_window_ml
\ No newline at end of file
+from lib.imports import lazy_attributes
+
+_lazy_attributes = {
+    'get_phi_psi_xray': 'lib.modules.compute_structures',
+    'get_phi_psi_predictions': 'lib.modules.compute_structures',
+    'seq_filter': 'lib.modules.compute_structures',
+    'get_phi_psi_af': 'lib.modules.compute_structures',
+    'query_and_process_pdbmine': 'lib.modules.query_pdbmine',
+    'get_da_for_all_predictions': 'lib.modules.compute_das',
+    'get_da_for_all_predictions_ml': 'lib.modules.compute_das',
+    'fit_linregr': 'lib.modules.fit_model',
+    'get_da_for_all_predictions_window': 'lib.modules.compute_das_window',
+    'get_da_for_all_predictions_window_ml': 'lib.modules.compute_das_window_ml',
+}
+__all__ = list(_lazy_attributes)
+__getattr__ = lazy_attributes(__name__, _lazy_attributes)
\ No newline at end of file
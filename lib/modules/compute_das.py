@@ -4,17 +4,17 @@
 ###############################################
 
 import numpy as np
-from lib.utils import calc_da, get_phi_psi_dist
+from lib.utils import calc_da, get_phi_psi_dist, find_kdepeak, get_kde_peak, get_kde_peaks_binned
 from pathlib import Path
 import pandas as pd
 from numpy.linalg import LinAlgError
-from lib.ml.utils import get_ml_pred
+from lib.schema import read_table, PREDICTIONS_DTYPES
 
 def get_da_for_all_predictions(ins, replace, da_scale, bw_method=None):
     if replace or not Path(ins.outdir / ins.pred_da_fn).exists():
         get_da_for_all_predictions_(ins, da_scale, bw_method)
     else:
-        ins.phi_psi_predictions = pd.read_csv(ins.outdir / ins.pred_da_fn)
+        ins.phi_psi_predictions = read_table(ins.outdir / ins.pred_da_fn, PREDICTIONS_DTYPES)
         ins.xray_phi_psi = pd.read_csv(ins.outdir / ins.xray_da_fn)
 
 def get_da_for_all_predictions_(ins, da_scale, scale_das=True, bw_method=None):
@@ -80,6 +80,12 @@ def get_da_for_all_predictions_(ins, da_scale, scale_das=True, bw_method=None):
         
         print(f'\tXray DA: {da_xray}', f'Pred DA: {np.nanmean(da)}' if preds.shape[0] > 0 else '')
     
+    scale_das_by_n_samples(ins, scale_das)
+
+    ins.phi_psi_predictions.to_csv(ins.outdir / ins.pred_da_fn, index=False)
+    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
+
+def scale_das_by_n_samples(ins, scale_das=True):
     # scale da by number of samples
     mean, std = ins.phi_psi_predictions['n_samples'].describe()[['mean', 'std']]
     # expected is mean-std/2, but at least 1
@@ -93,72 +99,116 @@ def get_da_for_all_predictions_(ins, da_scale, scale_das=True, bw_method=None):
         ins.xray_phi_psi['da'] = ins.xray_phi_psi['da'] * ins.xray_phi_psi['n_samples'].apply(scale)
         ins.phi_psi_predictions['da'] = ins.phi_psi_predictions['da'] * ins.phi_psi_predictions['n_samples'].apply(scale)
 
-    ins.phi_psi_predictions.to_csv(ins.outdir / ins.pred_da_fn, index=False)
-    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
-
 
 ############################## ML ######################################
 
+def get_saved_kde_method(fn):
+    # kde_method the saved ml DAs were computed with - files written before it was recorded used gaussian_kde
+    columns = pd.read_csv(fn, nrows=1)
+    return columns['kde_method'].iloc[0] if 'kde_method' in columns and columns.shape[0] > 0 else 'exact'
+
+def get_da_for_all_predictions_ml(ins, replace, da_scale, bw_method=None, kde_method='binned'):
+    if not replace and Path(ins.outdir / ins.pred_da_fn).exists():
+        saved_kde_method = get_saved_kde_method(ins.outdir / ins.pred_da_fn)
+        if saved_kde_method != kde_method:
+            print(f'Saved DAs were computed with kde_method={saved_kde_method} - recomputing with {kde_method}')
+            replace = True
+    if replace or not Path(ins.outdir / ins.pred_da_fn).exists():
+        get_da_for_all_predictions_ml_(ins, da_scale, bw_method=bw_method, kde_method=kde_method)
+    else:
+        ins.phi_psi_predictions = read_table(ins.outdir / ins.pred_da_fn, PREDICTIONS_DTYPES)
+        ins.xray_phi_psi = pd.read_csv(ins.outdir / ins.xray_da_fn)
 
-# def get_da_for_all_predictions_ml(ins, replace, da_scale):
-#     if replace or not Path(ins.outdir / 'phi_psi_predictions_da_ml.csv').exists():
-#         get_da_for_all_predictions_ml_(ins, da_scale)
-#     else:
-#         ins.phi_psi_predictions = pd.read_csv(ins.outdir / 'phi_psi_predictions_da_ml.csv')
-#         ins.xray_phi_psi = pd.read_csv(ins.outdir / 'xray_phi_psi_da_ml.csv')
-
-# def get_da_for_all_predictions_ml_(ins, da_scale):
-#     ins.phi_psi_predictions['da'] = np.nan
-#     ins.phi_psi_predictions['n_samples'] = np.nan
-#     ins.xray_phi_psi['da'] = np.nan
-#     ins.xray_phi_psi['n_samples'] = np.nan
-#     for i,seq in enumerate(ins.xray_phi_psi.seq_ctxt.unique()):
-#         print(f'{i}/{len(ins.xray_phi_psi.seq_ctxt.unique())-1}: {seq}')
-#         if 'X' in seq:
-#             print(f'\tSkipping {seq} - X in sequence')
-#             continue
-
-#         phi_psi_dist, info = get_phi_psi_dist(ins.queries, seq)
-#         for i in info:
-#             print(f'\tWin {i[0]}: {i[1]} - {i[2]} samples')
-
-#         # Calculate number of samples weighted by kdeweight
-#         weighted_n_samples = sum([i[2]*w for i,w in zip(info, da_scale)])
-#         ins.xray_phi_psi.loc[ins.xray_phi_psi.seq_ctxt == seq, 'n_samples'] = weighted_n_samples
-#         ins.phi_psi_predictions.loc[ins.phi_psi_predictions.seq_ctxt == seq, 'n_samples'] = weighted_n_samples
-#         print(f'\tWeighted n samples: {weighted_n_samples}')
-
-#         if phi_psi_dist.shape[0] < 2:
-#             print(f'\tSkipping {seq} - not enough samples')
-#             continue # leave as nan
-
-#         target = get_ml_pred(phi_psi_dist, ins.winsizes, ins.get_center(seq), ins.model)[['phi','psi']]
-
-#         # Distance to kde peak
-#         xray = ins.xray_phi_psi.loc[ins.xray_phi_psi.seq_ctxt == seq][['phi','psi']]
-#         if xray.shape[0] == 0:
-#             print(f'No xray seq {seq}')
-#         else:
-#             da_xray = calc_da(target.values, xray.values)
-#             ins.xray_phi_psi.loc[ins.xray_phi_psi.seq_ctxt == seq, 'da'] = da_xray
-        
-#         preds = ins.phi_psi_predictions.loc[ins.phi_psi_predictions.seq_ctxt == seq][['phi','psi']]
-#         print(f'\t{preds.shape[0]} predictions')
-#         if preds.shape[0] == 0:
-#             print(f'No predictions seq {seq}')
-#         else:
-#             da = calc_da(target.values, preds.values)
-#             ins.phi_psi_predictions.loc[ins.phi_psi_predictions.seq_ctxt == seq, 'da'] = da
-    
-#     # scale da by number of samples
-#     mean, std = ins.phi_psi_predictions['n_samples'].describe()[['mean', 'std']]
-#     # expected is mean-std/2, but at least 1
-#     expected = max(1,mean - std / 2)
-#     # if n_samples < expected, scale by n_samples / expected
-#     def scale(n_samples):
-#         return min(1, n_samples / expected)
-#     ins.xray_phi_psi['da'] = ins.xray_phi_psi['da'] * ins.xray_phi_psi['n_samples'].apply(scale)
-#     ins.phi_psi_predictions['da'] = ins.phi_psi_predictions['da'] * ins.phi_psi_predictions['n_samples'].apply(scale)
-
-#     ins.phi_psi_predictions.to_csv(ins.outdir / f'phi_psi_predictions_da_ml.csv', index=False)
-#     ins.xray_phi_psi.to_csv(ins.outdir / f'xray_phi_psi_da_ml.csv', index=False)
\ No newline at end of file
+def get_da_for_all_predictions_ml_(ins, da_scale, scale_das=True, bw_method=None, kde_method='binned'):
+    # Same as get_da_for_all_predictions_ with find_target from the 'ml' mode, but the kde peaks
+    # of all residues are found in one pass and the model is called once for the whole protein
+    # kde_method: 'binned' (periodic binned kde, peaks to within one 2 degree bin) or 'exact' (gaussian_kde)
+    bw_method = bw_method or ins.bw_method
+    if ins.af_phi_psi is not None:
+        afs = ins.af_phi_psi
+    else:
+        afs = ins.phi_psi_predictions[ins.phi_psi_predictions.protein_id == ins.alphafold_id]
+    afs = afs.drop_duplicates('seq_ctxt').set_index('seq_ctxt')
+
+    # matches for each window size, grouped by subsequence
+    matches = [(q.results[['phi', 'psi']].values, q.results.groupby('seq', observed=True).indices) for q in ins.queries]
+    no_matches = np.array([], dtype=int)
+
+    n_samples = {}
+    n_samples_list = {}
+    targets = {}
+    ml_seqs = []
+    xs = []
+    for seq in ins.xray_phi_psi.seq_ctxt.unique():
+        if 'X' in seq:
+            print(f'Skipping {seq} - X in sequence')
+            continue
+        windows = [vals[idx.get(q.get_subseq(seq), no_matches)] for q,(vals,idx) in zip(ins.queries, matches)]
+        counts = [w.shape[0] for w in windows]
+        n_samples[seq] = sum([n*w for n,w in zip(counts, da_scale)])
+        n_samples_list[seq] = str(counts)
+
+        if sum(counts) < 2:
+            print(f'Skipping {seq} - not enough samples')
+            continue # leave as nan
+
+        if seq not in afs.index:
+            print(f'{seq}: No AlphaFold prediction - Using ordinary KDE')
+            phi_psi_dist, _ = get_phi_psi_dist(ins.queries, seq)
+            try:
+                targets[seq] = find_kdepeak(phi_psi_dist, bw_method)[['phi','psi']].values
+            except LinAlgError as e:
+                print(f'{seq}: Singular Matrix - skipping')
+            except ValueError as e:
+                print(f'{seq}: Sample count error - skipping')
+            continue
+        if 'conf' in afs.columns and afs.at[seq, 'conf'] < 50:
+            print(f'{seq}: low confidence')
+
+        ml_seqs.append(seq)
+        xs.extend([w[~np.isnan(w).any(axis=1)] for w in windows])
+
+    # kde peak of each window size for each residue
+    if kde_method == 'binned':
+        peaks, ok = get_kde_peaks_binned(xs)
+    elif kde_method == 'exact':
+        peaks = np.zeros((len(xs), 2))
+        ok = np.ones(len(xs), dtype=bool)
+        for k,x in enumerate(xs):
+            try:
+                peaks[k] = get_kde_peak(x.T)
+            except (LinAlgError, ValueError) as e:
+                ok[k] = False
+    else:
+        raise ValueError(f'Unknown kde_method {kde_method}')
+    n_win = len(ins.queries)
+    peaks = peaks.reshape(len(ml_seqs), n_win, 2)
+    ok = ok.reshape(len(ml_seqs), n_win).all(axis=1)
+    for seq in np.array(ml_seqs)[~ok]:
+        print(f'{seq}: Singular Matrix - skipping')
+
+    ml_seqs = [seq for seq,k in zip(ml_seqs, ok) if k]
+    if len(ml_seqs) > 0:
+        from lib.ml.utils import get_ml_preds
+        preds = get_ml_preds(
+            peaks[ok], [ins.get_center(seq) for seq in ml_seqs],
+            afs.loc[ml_seqs, ['phi', 'psi']].values, ins.model
+        )
+        targets.update(zip(ml_seqs, preds))
+    print(f'Targets found for {len(targets)}/{len(n_samples)} residues')
+
+    targets = pd.DataFrame(
+        np.array(list(targets.values())).reshape(-1, 2), index=list(targets.keys()), columns=['phi', 'psi']
+    )
+    for df in [ins.xray_phi_psi, ins.phi_psi_predictions]:
+        target = targets.reindex(df.seq_ctxt.values).values
+        df['da'] = calc_da(target.T, df[['phi','psi']].values)
+        df['n_samples'] = df.seq_ctxt.map(n_samples)
+        df['n_samples_list'] = df.seq_ctxt.map(n_samples_list).fillna('')
+        # recorded so saved results of the two kde methods are never mixed up
+        df['kde_method'] = pd.Categorical([kde_method] * df.shape[0])
+
+    scale_das_by_n_samples(ins, scale_das)
+
+    ins.phi_psi_predictions.to_csv(ins.outdir / ins.pred_da_fn, index=False)
+    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
@@ -4,33 +4,71 @@
 ###############################################
 
 from lib.across_window_utils import (
-    get_combined_phi_psi_dist,
+    get_combined_phi_psi_dist_arrays,
+    get_window_sample_counts,
+    get_window_info,
     get_xrays_window,
     get_afs_window,
     get_preds_window,
     precompute_dists,
     find_clusters,
     filter_precomputed_dists,
-    calc_da_for_one_window,
-    calc_da_window,
-    get_target_cluster_icov,
+    calc_da_window_batch,
+    get_cluster_medoids,
+    get_target_cluster_chol,
+    save_window_clusters,
+    load_window_clusters,
+    WINDOW_CLUSTERS_FN,
 )
-from lib.utils import get_phi_psi_dist
+from lib.window_executor import run_over_residues
+from lib.schema import read_table, PREDICTIONS_DTYPES
+from scipy.linalg import cho_solve
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 MIN_SAMPLES = [100, 20, 1, 1]
 MIN_CLUSTER_SIZES = [20, 5, 1, 1]
+CLUSTER_SELECTION_EPSILON = 30
 
-def get_da_for_all_predictions_window(ins, replace):
+def get_da_for_all_predictions_window(ins, replace, n_jobs=1):
     if replace or not Path(ins.outdir / ins.pred_da_fn).exists():
-        get_da_for_all_predictions_window_(ins)
+        get_da_for_all_predictions_window_(ins, n_jobs)
     else:
-        ins.phi_psi_predictions = pd.read_csv(ins.outdir / ins.pred_da_fn)
+        ins.phi_psi_predictions = read_table(ins.outdir / ins.pred_da_fn, PREDICTIONS_DTYPES)
         ins.xray_phi_psi = pd.read_csv(ins.outdir / ins.xray_da_fn)
+        if (ins.outdir / WINDOW_CLUSTERS_FN).exists():
+            ins.window_clusters = load_window_clusters(ins.outdir / WINDOW_CLUSTERS_FN)
+
+def cluster_residue_window(match_arrays, winsize_ctxt, seq_ctxt, afs):
+    # Cluster the combined pdbmine matches for one residue and find the target cluster
+    # Runs in worker processes, so it only returns arrays and messages
+    phi_psi_dist_v = get_combined_phi_psi_dist_arrays(match_arrays, seq_ctxt, winsize_ctxt)
+    if phi_psi_dist_v is None or phi_psi_dist_v.shape[0] == 0:
+        return {'error': f"No pdbmine data for {seq_ctxt}"}
+    if phi_psi_dist_v.shape[0] < MIN_SAMPLES[0]:
+        return {'error': f"Not enough pdbmine data for {seq_ctxt}"}
+
+    precomputed_dists = precompute_dists(phi_psi_dist_v)
+    n_clusters, clusters = find_clusters(precomputed_dists, MIN_CLUSTER_SIZES[0], CLUSTER_SELECTION_EPSILON)
+    if n_clusters == 0:
+        return {'error': f"No clusters found for {seq_ctxt}"}
+    labels = clusters
+    precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+    cluster_ids, medoids, cluster_counts = get_cluster_medoids(phi_psi_dist_v, precomputed_dists, clusters)
+    target_cluster, target, chol = get_target_cluster_chol(phi_psi_dist_v, clusters, afs, cluster_ids, medoids)
+    return {
+        'error': None if chol is not None else f"Error calculating mahalanobis distance for {seq_ctxt}",
+        'labels': labels,
+        'cluster_ids': cluster_ids,
+        'medoids': medoids,
+        'cluster_counts': cluster_counts,
+        'target_cluster': target_cluster,
+        'target': target,
+        'chol': chol,
+    }
     
-def get_da_for_all_predictions_window_(ins):
+def get_da_for_all_predictions_window_(ins, n_jobs=1):
     ins.phi_psi_predictions['da'] = np.nan
     ins.phi_psi_predictions['n_samples'] = np.nan
     ins.phi_psi_predictions['n_samples_list'] = ''
@@ -41,14 +79,18 @@ def get_da_for_all_predictions_window_(ins):
     center_idx_ctxt = ins.queries[-1].get_center_idx_pos()
     winsize_ctxt = ins.queries[-1].winsize
     seqs_for_window = ins.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
+    seq_counts = get_window_sample_counts(ins.queries)
 
+    # (i, seq_ctxt, xrays, preds, info) for each residue with complete xray, prediction and AF windows
+    residues = []
+    tasks = []
     for i,seq_ctxt in enumerate(seqs_for_window):
         print(f'{i}/{len(ins.xray_phi_psi.seq_ctxt.unique())-1}: {seq_ctxt}')
         if 'X' in seq_ctxt:
             print(f'\tSkipping {seq_ctxt} - X in sequence')
             continue
 
-        _, info = get_phi_psi_dist(ins.queries, seq_ctxt)
+        info = get_window_info(ins.queries, seq_counts, seq_ctxt)
         for j in info:
             print(f'\tWin {j[0]}: {j[1]} - {j[2]} samples')
 
@@ -68,38 +110,65 @@ def get_da_for_all_predictions_window_(ins):
         if afs is None or afs.shape[0] != q.winsize*2:
             print(f"AF data for {seq_ctxt} is incomplete")
             continue
-        
-        phi_psi_dist, phi_psi_dist_v = get_combined_phi_psi_dist(ins, seq_ctxt)
-        if phi_psi_dist is None or phi_psi_dist.shape[0] == 0:
-            print(f"No pdbmine data for {seq_ctxt}")
-            continue
-        if phi_psi_dist.shape[0] < MIN_SAMPLES[0]:
-            print(f"Not enough pdbmine data for {seq_ctxt}")
-            continue
 
-        precomputed_dists = precompute_dists(phi_psi_dist_v)
-        n_clusters, clusters = find_clusters(precomputed_dists, MIN_CLUSTER_SIZES[0])
-        if n_clusters == 0:
-            print(f"No clusters found for {seq_ctxt}")
-            continue
-        precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
-        target_cluster, target, icov = get_target_cluster_icov(phi_psi_dist_v, precomputed_dists, clusters, afs)
-        if icov is None:
-            print(f"Error calculating mahalanobis distance for {seq_ctxt}")
+        residues.append((i, seq_ctxt, xrays, preds, info))
+        tasks.append((seq_ctxt, afs))
+
+    # Clustering is independent for each residue - run it in parallel
+    print(f'Clustering {len(tasks)} residues ({n_jobs} jobs)')
+    results = run_over_residues(ins, cluster_residue_window, tasks, n_jobs)
+
+    # (i, seq_ctxt, xrays, preds, target, chol) for each residue that can be scored
+    scored = []
+    # clustering artifacts for each clustered residue, persisted for plotting
+    residue_clusters = []
+    for (i, seq_ctxt, xrays, preds, info), result in zip(residues, results):
+        if 'labels' in result:
+            chol = result['chol']
+            residue_clusters.append({
+                'seq_ctxt': seq_ctxt,
+                'labels': result['labels'],
+                'cluster_ids': result['cluster_ids'],
+                'medoids': result['medoids'],
+                'cluster_counts': result['cluster_counts'],
+                'target_cluster': -1 if chol is None else result['target_cluster'],
+                'icov': np.full((result['medoids'].shape[1],)*2, np.nan) if chol is None else cho_solve((chol, True), np.eye(chol.shape[0])),
+                'n_samples': [j[2] for j in info],
+            })
+        if result['error'] is not None:
+            print(result['error'])
             continue
+        scored.append((i, seq_ctxt, xrays, preds, result['target'], result['chol']))
 
-        xray_maha = calc_da_for_one_window(xrays, target, icov)
-        preds_maha = calc_da_window(preds, target, icov)
+    if len(scored) > 0:
+        # Score xrays and predictions for all residues at once
+        max_preds = max(s[3].shape[0] for s in scored)
+        preds_points = np.full((len(scored), max_preds, scored[0][3].shape[1]), np.nan)
+        for k,s in enumerate(scored):
+            preds_points[k,:s[3].shape[0]] = s[3].values
+        targets = np.stack([s[4] for s in scored])
+        chols = np.stack([s[5] for s in scored])
+        xrays_maha = calc_da_window_batch(np.stack([s[2] for s in scored])[:,np.newaxis], targets, chols)[:,0]
+        preds_maha = calc_da_window_batch(preds_points, targets, chols)
 
-        print(f'\t{i}: {xray_maha:.2f}, {np.nanmean(preds_maha):.2f}')
+        for k,(i, seq_ctxt, _, preds, _, _) in enumerate(scored):
+            print(f'\t{i}: {xrays_maha[k]:.2f}, {np.nanmean(preds_maha[k,:preds.shape[0]]):.2f}')
 
-        # Distance from preds to xray
+        # Gather distances back into the DataFrames in one step
         col_name = f'da'
-        ins.xray_phi_psi.loc[ins.xray_phi_psi.seq_ctxt == seq_ctxt, col_name] = xray_maha
-
-        view = ins.phi_psi_predictions.loc[ins.phi_psi_predictions.seq_ctxt == seq_ctxt].reset_index().set_index('protein_id')
-        view.loc[preds.index, col_name] = preds_maha
-        ins.phi_psi_predictions.loc[view['index'], col_name] = view.set_index('index')[col_name]
+        xray_da = pd.Series(xrays_maha, index=[s[1] for s in scored])
+        ins.xray_phi_psi[col_name] = ins.xray_phi_psi.seq_ctxt.map(xray_da)
+        preds_da = pd.concat([
+            pd.Series(preds_maha[k,:s[3].shape[0]], index=pd.MultiIndex.from_product([[s[1]], s[3].index]))
+            for k,s in enumerate(scored)
+        ])
+        keys = pd.MultiIndex.from_frame(ins.phi_psi_predictions[['seq_ctxt', 'protein_id']])
+        ins.phi_psi_predictions[col_name] = preds_da.reindex(keys).values
 
     ins.phi_psi_predictions.to_csv(ins.outdir / ins.pred_da_fn, index=False)
-    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
\ No newline at end of file
+    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
+    save_window_clusters(
+        ins.outdir / WINDOW_CLUSTERS_FN, residue_clusters, 
+        MIN_CLUSTER_SIZES[0], CLUSTER_SELECTION_EPSILON, [q.weight for q in ins.queries]
+    )
+    ins.window_clusters = load_window_clusters(ins.outdir / WINDOW_CLUSTERS_FN)
@@ -4,32 +4,58 @@
 ###############################################
 
 from lib.across_window_utils import (
-    get_combined_phi_psi_dist,
+    get_combined_phi_psi_dist_arrays,
+    get_window_sample_counts,
+    get_window_info,
     get_xrays_window,
     get_afs_window,
     get_preds_window,
     precompute_dists,
     find_clusters,
     filter_precomputed_dists,
-    get_cluster_medoid
+    get_cluster_medoids
 )
-from lib.utils import get_phi_psi_dist
+from lib.window_executor import run_over_residues
+from lib.schema import read_table, PREDICTIONS_DTYPES
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from lib.ml.models import MLPredictorWindow
 
 MIN_SAMPLES = [100, 20, 1, 1]
 MIN_CLUSTER_SIZES = [20, 5, 1, 1]
 
-def get_da_for_all_predictions_window_ml(ins, replace):
+def get_da_for_all_predictions_window_ml(ins, replace, n_jobs=1, batch_size=256):
     if replace or not Path(ins.outdir / ins.pred_da_fn).exists():
-        get_da_for_all_predictions_window_ml_(ins)
+        get_da_for_all_predictions_window_ml_(ins, n_jobs, batch_size)
     else:
-        ins.phi_psi_predictions = pd.read_csv(ins.outdir / ins.pred_da_fn)
+        ins.phi_psi_predictions = read_table(ins.outdir / ins.pred_da_fn, PREDICTIONS_DTYPES)
         ins.xray_phi_psi = pd.read_csv(ins.outdir / ins.xray_da_fn)
+
+def cluster_residue_window_ml(match_arrays, winsize_ctxt, seq_ctxt, winsizes, n_medoids):
+    # Medoids of the n_medoids largest clusters of the pdbmine matches for one residue
+    # Runs in worker processes, so it only returns arrays and messages
+    phi_psi_dist_v = get_combined_phi_psi_dist_arrays(match_arrays, seq_ctxt, winsize_ctxt, winsizes)
+    if phi_psi_dist_v is None or phi_psi_dist_v.shape[0] <= 1: # TODO seperate case for 1
+        return {'error': f"No pdbmine data for {seq_ctxt}"}
+
+    precomputed_dists = precompute_dists(phi_psi_dist_v)
+    n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=np.min([phi_psi_dist_v.shape[0], 20]))
+    if n_clusters == 0:
+        n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=2, cluster_selection_epsilon=60)
+    if n_clusters == 0:
+        n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=2, cluster_selection_epsilon=120)
+    if n_clusters == 0:
+        return {'error': f"No clusters found for {seq_ctxt}"}
+    precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+
+    # Medoids of the largest clusters, zero-padded to n_medoids
+    _, cluster_medoids, cluster_counts = get_cluster_medoids(phi_psi_dist_v, precomputed_dists, clusters)
+    largest = np.argsort(-cluster_counts, kind='stable')[:n_medoids]
+    medoids = np.zeros([n_medoids, phi_psi_dist_v.shape[1]])
+    medoids[:len(largest)] = cluster_medoids[largest]
+    return {'error': None, 'medoids': medoids}
     
-def get_da_for_all_predictions_window_ml_(ins):
+def get_da_for_all_predictions_window_ml_(ins, n_jobs=1, batch_size=256):
     ins.phi_psi_predictions['da'] = np.nan
     ins.phi_psi_predictions['n_samples'] = np.nan
     ins.phi_psi_predictions['n_samples_list'] = ''
@@ -40,14 +66,18 @@ def get_da_for_all_predictions_window_ml_(ins):
     center_idx_ctxt = ins.queries[-1].get_center_idx_pos()
     winsize_ctxt = ins.queries[-1].winsize
     seqs_for_window = ins.seqs[center_idx_ctxt:-(winsize_ctxt - center_idx_ctxt - 1)]
+    seq_counts = get_window_sample_counts(ins.queries)
 
+    # (i, seq_ctxt, xrays, preds) for each residue with complete xray, prediction and AF windows
+    residues = []
+    tasks = []
     for i,seq_ctxt in enumerate(seqs_for_window):
         print(f'{i}/{len(ins.xray_phi_psi.seq_ctxt.unique())-1}: {seq_ctxt}')
         if 'X' in seq_ctxt:
             print(f'\tSkipping {seq_ctxt} - X in sequence')
             continue
 
-        _, info = get_phi_psi_dist(ins.queries, seq_ctxt)
+        info = get_window_info(ins.queries, seq_counts, seq_ctxt)
         for j in info:
             print(f'\tWin {j[0]}: {j[1]} - {j[2]} samples')
 
@@ -66,50 +96,50 @@ def get_da_for_all_predictions_window_ml_(ins):
         if afs is None or afs.shape[0] != q.winsize*2:
             print(f"AF data for {seq_ctxt} is incomplete")
             continue
-        
-        phi_psi_dist, phi_psi_dist_v = get_combined_phi_psi_dist(ins, seq_ctxt, winsizes=[ins.winsizes[-1]])
-        if phi_psi_dist is None or phi_psi_dist.shape[0] <= 1: # TODO seperate case for 1
-            print(f"No pdbmine data for {seq_ctxt}")
-            continue
 
-        precomputed_dists = precompute_dists(phi_psi_dist_v)
-        n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=np.min([phi_psi_dist_v.shape[0], 20]))
-        if n_clusters == 0:
-            n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=2, cluster_selection_epsilon=60)
-        if n_clusters == 0:
-            n_clusters, clusters = find_clusters(precomputed_dists, min_cluster_size=2, cluster_selection_epsilon=120)
-        if n_clusters == 0:
-            print(f"No clusters found for {seq_ctxt}")
-            continue
-        precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+        residues.append((i, seq_ctxt, xrays, preds))
+        tasks.append((seq_ctxt, [ins.winsizes[-1]], ins.ml_lengths[-1]))
 
-        # Get target phi psi for center residue with model
-        cluster_counts = pd.Series(clusters).value_counts().sort_values(ascending=False)
-        medoids = np.zeros([ins.ml_lengths[-1], ins.queries[-1].winsize*2])
-        for k,cluster in zip(range(ins.ml_lengths[-1]), cluster_counts.index):
-            medoid = get_cluster_medoid(phi_psi_dist_v, precomputed_dists, clusters, cluster)
-            medoids[k] = medoid
+    # Clustering is independent for each residue - run it in parallel
+    print(f'Clustering {len(tasks)} residues ({n_jobs} jobs)')
+    results = run_over_residues(ins, cluster_residue_window_ml, tasks, n_jobs)
+
+    # Stage 1: gather the medoids of every residue that could be clustered
+    eligible = []
+    medoids = []
+    for (i, seq_ctxt, xrays, preds), result in zip(residues, results):
+        if result['error'] is not None:
+            print(result['error'])
+            continue
+        eligible.append((i, seq_ctxt, xrays, preds))
+        medoids.append(result['medoids'])
 
+    if len(eligible) > 0:
+        # Stage 2: get target phi psi for the center residue of every residue with the model, in batches
+        q = ins.queries[-1]
         c_idx = q.get_center_idx_pos()
-        target = ins.model.predict(medoids, seq_ctxt).numpy()[0,c_idx]
+        targets = ins.model.predict_batch(np.stack(medoids), [e[1] for e in eligible], batch_size).numpy()[:,c_idx]
 
         def diff(x1, x2):
             d = np.abs(x1 - x2)
             return np.minimum(d, 360-d)
-        preds_point = preds.values.reshape(-1, 2, ins.winsizes[-1]).transpose((0,2,1))[:,c_idx]
-        xray_point = xrays.reshape(2, ins.winsizes[-1]).T[c_idx]
-        xray_da = np.linalg.norm(diff(xray_point, target))
-        preds_da = np.linalg.norm(diff(preds_point, target), axis=1)
-
-        print(f'\t{i}: {xray_da:.2f}, {np.nanmean(preds_da):.2f}')
-
-        # Distance from preds to xray
+        xrays_da = []
+        preds_da = []
+        for (i, seq_ctxt, xrays, preds), target in zip(eligible, targets):
+            preds_point = preds.values.reshape(-1, 2, ins.winsizes[-1]).transpose((0,2,1))[:,c_idx]
+            xray_point = xrays.reshape(2, ins.winsizes[-1]).T[c_idx]
+            xrays_da.append(np.linalg.norm(diff(xray_point, target)))
+            preds_da.append(pd.Series(
+                np.linalg.norm(diff(preds_point, target), axis=1), 
+                index=pd.MultiIndex.from_product([[seq_ctxt], preds.index])
+            ))
+            print(f'\t{i}: {xrays_da[-1]:.2f}, {np.nanmean(preds_da[-1]):.2f}')
+
+        # Gather distances back into the DataFrames in one step
         col_name = f'da'
-        ins.xray_phi_psi.loc[ins.xray_phi_psi.seq_ctxt == seq_ctxt, col_name] = xray_da
-
-        view = ins.phi_psi_predictions.loc[ins.phi_psi_predictions.seq_ctxt == seq_ctxt].reset_index().set_index('protein_id')
-        view.loc[preds.index, col_name] = preds_da
-        ins.phi_psi_predictions.loc[view['index'], col_name] = view.set_index('index')[col_name]
+        ins.xray_phi_psi[col_name] = ins.xray_phi_psi.seq_ctxt.map(pd.Series(xrays_da, index=[e[1] for e in eligible]))
+        keys = pd.MultiIndex.from_frame(ins.phi_psi_predictions[['seq_ctxt', 'protein_id']])
+        ins.phi_psi_predictions[col_name] = pd.concat(preds_da).reindex(keys).values
 
     ins.phi_psi_predictions.to_csv(ins.outdir / ins.pred_da_fn, index=False)
-    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
\ No newline at end of file
+    ins.xray_phi_psi.to_csv(ins.outdir / ins.xray_da_fn, index=False)
@@ -5,19 +5,28 @@
 
 from Bio.PDB.ic_rebuild import structure_rebuild_test
 from Bio.PDB import PDBParser
+from Bio.PDB.internal_coords import IC_Chain, IC_Residue
+from Bio.Data.PDBData import protein_letters_3to1
 import numpy as np
 from lib.constants import AMINO_ACID_CODES
+from lib.utils import get_seq_funcs, get_structure_hash
+from lib.retrieve_data import iter_predictions
+from lib.schema import apply_schema, read_table, PREDICTIONS_DTYPES
+import io
 import warnings
 from tqdm import tqdm
 import pandas as pd
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
 
-def get_phi_psi_xray(ins, replace):
+def get_phi_psi_xray(ins, replace, validate=False):
     if not (ins.outdir / 'xray_phi_psi.csv').exists() or replace:
         print('Computing phi-psi for xray')
         parser = PDBParser()
         xray_structure = parser.get_structure(ins.pdb_code, ins.xray_fn)
         xray_chain = list(xray_structure[0].get_chains())[0]
-        xray_phi_psi = get_phi_psi_for_structure(ins, xray_structure, ins.pdb_code)
+        xray_phi_psi = get_phi_psi_for_structure(ins, xray_structure, ins.pdb_code, validate=validate)
         xray_phi_psi = pd.DataFrame(xray_phi_psi, columns=['pos', 'seq_ctxt', 'res', 'phi', 'psi', 'protein_id'])
         xray_phi_psi.to_csv(ins.outdir / 'xray_phi_psi.csv', index=False)
     else:
@@ -25,54 +34,166 @@ def get_phi_psi_xray(ins, replace):
 
     return xray_phi_psi
 
-def get_phi_psi_predictions(ins, replace):
+def get_phi_psi_predictions(ins, replace, validate=False, n_jobs=1):
     if not (ins.outdir / 'phi_psi_predictions.csv').exists() or replace:
         print('Computing phi-psi for predictions')
-        parser = PDBParser()
-        phi_psi_predictions_ = []
-        for prediction_pdb in tqdm(ins.predictions_dir.iterdir()):
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    prediction = parser.get_structure(prediction_pdb.name, prediction_pdb)
-                    try:
-                        chain = list(prediction[0].get_chains())[0]
-                        phi_psi_predictions_ += get_phi_psi_for_structure(ins, prediction, prediction.id)
-                    except Exception as e:
-                        print(prediction_pdb.name, e)
-
-        phi_psi_predictions = pd.DataFrame(phi_psi_predictions_, columns=['pos', 'seq_ctxt', 'res', 'phi', 'psi', 'protein_id'])
+        # Models are streamed one at a time, straight from the tarball if the predictions were not extracted,
+        # and hashed as they are read - models with identical structure content are only parsed once
+        prediction_pdbs = []
+        representatives = []
+        results = {}
+        first = {}
+        with contextlib.ExitStack() as stack:
+            if n_jobs > 1:
+                # Each model is parsed independently (from its contents, in memory) in a worker process
+                # At most 2*n_jobs models wait in the pool, so their contents are dropped once parsed
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn'))
+                )
+                pending = set()
+            progress = stack.enter_context(tqdm())
+            for pdb, data in iter_predictions(ins.predictions_dir):
+                prediction_pdbs.append(pdb)
+                representatives.append(first.setdefault(get_structure_hash(pdb, data), pdb))
+                if representatives[-1] is not pdb:
+                    continue
+                if n_jobs == 1:
+                    results[pdb] = get_phi_psi_for_prediction(pdb, ins.winsize_ctxt, validate, data)
+                    progress.update()
+                    continue
+                if len(pending) >= 2 * n_jobs:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    progress.update(len(done))
+                future = executor.submit(get_phi_psi_for_prediction, pdb, ins.winsize_ctxt, validate, data)
+                pending.add(future)
+                results[pdb] = future
+            if n_jobs > 1:
+                progress.update(len(wait(pending).done))
+                results = {pdb: future.result() for pdb,future in results.items()}
+        print(f'{len(results)} unique structures in {len(prediction_pdbs)} models')
+        # protein_id is the file name
+        results = [(pdb.name, *results[rep][1:]) for pdb,rep in zip(prediction_pdbs, representatives)]
+
+        failed = [(protein_id, error) for protein_id,_,error in results if error is not None]
+        for protein_id, error in failed:
+            print(protein_id, error)
+        if len(failed) > 0:
+            print(f'{len(failed)}/{len(results)} prediction models failed')
+
+        # Concatenate the models' arrays once
+        results = [(protein_id, arrays) for protein_id,arrays,error in results if error is None]
+        columns = ['pos', 'seq_ctxt', 'res', 'phi', 'psi']
+        phi_psi_predictions = pd.DataFrame({
+            col: np.concatenate([arrays[col] for _,arrays in results] + [np.array([])]) for col in columns
+        })
+        phi_psi_predictions['protein_id'] = pd.Categorical(np.repeat(
+            [protein_id for protein_id,_ in results], [len(arrays['pos']) for _,arrays in results]
+        ))
+        phi_psi_predictions = apply_schema(phi_psi_predictions, PREDICTIONS_DTYPES)
         phi_psi_predictions.to_csv(ins.outdir / 'phi_psi_predictions.csv', index=False)
     else:
-        phi_psi_predictions = pd.read_csv(ins.outdir / 'phi_psi_predictions.csv')
+        phi_psi_predictions = read_table(ins.outdir / 'phi_psi_predictions.csv', PREDICTIONS_DTYPES)
     
     return phi_psi_predictions
 
-def get_phi_psi_for_structure(ins, protein_structure, protein_id, bfactor=False):
-    protein_structure.atom_to_internal_coordinates(verbose=False)
-    resultDict = structure_rebuild_test(protein_structure)
-    if not resultDict['pass']:
-        raise Exception('Failed to rebuild')
+def get_phi_psi_for_prediction(prediction_pdb, winsize_ctxt, validate=False, data=None):
+    # Parse one prediction model (from data, its file contents, if given) and compute its phi-psi arrays
+    # - runs in worker processes
+    # Returns (protein_id, arrays or None, error message or None)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            source = prediction_pdb if data is None else io.StringIO(data.decode())
+            prediction = PDBParser().get_structure(prediction_pdb.name, source)
+            return prediction.id, get_phi_psi_arrays_for_structure(prediction, winsize_ctxt, validate=validate), None
+    except Exception as e:
+        return prediction_pdb.name, None, f'{type(e).__name__}: {e}'
+
+def get_backbone_arrays(residues):
+    # N, CA and C coordinates (3, R, 3) of each residue, nan where missing, whether each is in the chain
+    # Bio.PDB builds internal coordinates for (not hetero), and whether it is an accepted amino acid
+    coords = np.full((3, len(residues), 3), np.nan)
+    for i,r in enumerate(residues):
+        for j,name in enumerate(['N', 'CA', 'C']):
+            if name in r:
+                coords[j,i] = r[name].coord
+    in_chain = np.array([r.id[0] == ' ' for r in residues], dtype=bool)
+    accepted = np.array([
+        r.resname in protein_letters_3to1 or r.resname in IC_Residue.accept_resnames for r in residues
+    ], dtype=bool)
+    return coords, in_chain, accepted
+
+def calc_dihedrals(p0, p1, p2, p3):
+    # Dihedral angles (degrees) of each row of 4 (n, 3) point arrays
+    b0 = p0 - p1
+    b1 = p2 - p1
+    b2 = p3 - p2
+    b1 = b1 / np.linalg.norm(b1, axis=1, keepdims=True)
+    v = b0 - np.sum(b0*b1, axis=1, keepdims=True) * b1
+    w = b2 - np.sum(b2*b1, axis=1, keepdims=True) * b1
+    x = np.sum(v*w, axis=1)
+    y = np.sum(np.cross(b1, v) * w, axis=1)
+    return np.degrees(np.arctan2(y, x))
+
+def get_phi_psi_arrays(residues, max_peptide_bond=IC_Chain.MaxPeptideBond):
+    # phi and psi of every residue in one vectorized calculation - nan at chain ends, at chain breaks
+    # (previous C to N further than max_peptide_bond) and for residues missing backbone atoms
+    coords, in_chain, accepted = get_backbone_arrays(residues)
+    phi = np.full(len(residues), np.nan)
+    psi = np.full(len(residues), np.nan)
+    idx = np.flatnonzero(in_chain)
+    if len(idx) < 2:
+        return phi, psi
+    N, CA, C = coords[:, idx]
+    complete = ~np.isnan(coords[:, idx]).any(axis=(0, 2)) & accepted[idx]
+    # peptide bond between consecutive chain residues k, k+1: k complete, k+1 an accepted amino acid
+    # and C(k) - N(k+1) in range
+    with np.errstate(invalid='ignore'):
+        bonded = complete[:-1] & accepted[idx[1:]] & (np.linalg.norm(N[1:] - C[:-1], axis=1) <= max_peptide_bond)
+        phi_ = calc_dihedrals(C[:-1], N[1:], CA[1:], C[1:]) # C(k-1), N(k), CA(k), C(k)
+        psi_ = calc_dihedrals(N[:-1], CA[:-1], C[:-1], N[1:]) # N(k), CA(k), C(k), N(k+1)
+    has_phi = bonded & complete[1:]
+    phi[idx[1:][has_phi]] = phi_[has_phi]
+    psi[idx[:-1][bonded]] = psi_[bonded]
+    return phi, psi
+
+def get_phi_psi_arrays_for_structure(protein_structure, winsize_ctxt, bfactor=False, validate=False):
+    # Columns pos, seq_ctxt, res, phi, psi (and conf, the mean atom bfactor) of every residue
+    # with a full context window, as arrays
+    if validate:
+        protein_structure.atom_to_internal_coordinates(verbose=False)
+        resultDict = structure_rebuild_test(protein_structure)
+        if not resultDict['pass']:
+            raise Exception('Failed to rebuild')
+    _, get_center, get_seq_ctxt = get_seq_funcs(winsize_ctxt)
     # TODO if you index the chain object you get position in chain rather than index in list
     chain = next(iter((protein_structure[0].get_chains())))
     residues = list(chain.get_residues())
+    phis, psis = get_phi_psi_arrays(residues)
+    # Convert 3 char codes to 1 char codes
+    codes = [AMINO_ACID_CODES.get(r.resname, 'X') for r in residues]
+    pos = np.arange(winsize_ctxt//2, len(residues) - winsize_ctxt // 2)
+    seq_ctxt = np.array([''.join(get_seq_ctxt(codes, i)) for i in pos], dtype=object)
+    arrays = {
+        'pos': pos,
+        'seq_ctxt': seq_ctxt,
+        'res': np.array([get_center(seq) for seq in seq_ctxt], dtype=object),
+        'phi': phis[pos],
+        'psi': psis[pos],
+    }
+    if bfactor:
+        arrays['conf'] = np.array([np.mean([atom.bfactor for atom in residues[i]]) for i in pos])
+    return arrays
+
+def get_phi_psi_for_structure(ins, protein_structure, protein_id, bfactor=False, validate=False):
+    arrays = get_phi_psi_arrays_for_structure(protein_structure, ins.winsize_ctxt, bfactor, validate)
+    columns = ['pos', 'seq_ctxt', 'res', 'phi', 'psi']
     phi_psi_ = []
-    for i in range(ins.winsize_ctxt//2, len(residues) - ins.winsize_ctxt // 2):
-        # Convert 3 char codes to 1 char codes
-        seq_ctxt = ''.join([AMINO_ACID_CODES.get(r.resname, 'X') for r in ins.get_seq_ctxt(residues, i)])
-        # Get the center residue
-        res = ins.get_center(seq_ctxt)
-        if not residues[i].internal_coord:
-            psi,phi = np.nan, np.nan
-        else:
-            psi = residues[i].internal_coord.get_angle("psi")
-            phi = residues[i].internal_coord.get_angle("phi")
-            psi = psi if psi else np.nan # if psi is None, set it to np.nan
-            phi = phi if phi else np.nan # if phi is None, set it to np.nan
+    for i in range(len(arrays['pos'])):
+        row = [arrays[col][i] for col in columns] + [protein_id]
         if bfactor:
-            ave_bfactor = np.mean([atom.bfactor for atom in residues[i]])
-            phi_psi_.append([i, seq_ctxt, res, phi, psi, protein_id, ave_bfactor])
-        else:
-            phi_psi_.append([i, seq_ctxt, res, phi, psi, protein_id])
+            row.append(arrays['conf'][i])
+        phi_psi_.append(row)
     return phi_psi_
 
 def seq_filter(ins):
@@ -85,7 +206,7 @@ def seq_filter(ins):
     # remove all predictions with outlier number of overlapping sequences with xray
     # or outlier length
     xray_seqs_unique = set(ins.xray_phi_psi.seq_ctxt.unique())
-    grouped = ins.phi_psi_predictions.groupby('protein_id').agg(
+    grouped = ins.phi_psi_predictions.groupby('protein_id', observed=True).agg(
         n_overlapping_seqs=('seq_ctxt', lambda series: len(set(series.unique()) & xray_seqs_unique)),
         length=('seq_ctxt', 'count')
     )
@@ -97,13 +218,13 @@ def seq_filter(ins):
         ins.phi_psi_predictions.protein_id.isin(grouped.index)
     ]
 
-def get_phi_psi_af(ins, replace=False):
+def get_phi_psi_af(ins, replace=False, validate=False):
     if not (ins.outdir / 'af_phi_psi.csv').exists() or replace:
         print('Computing phi-psi for alphafold')
         parser = PDBParser()
         af_structure = parser.get_structure(ins.pdb_code, ins.af_fn)
         print(ins.af_fn)
-        af_phi_psi = get_phi_psi_for_structure(ins, af_structure, ins.pdb_code, bfactor=True)
+        af_phi_psi = get_phi_psi_for_structure(ins, af_structure, ins.pdb_code, bfactor=True, validate=validate)
         af_phi_psi = pd.DataFrame(af_phi_psi, columns=['pos', 'seq_ctxt', 'res', 'phi', 'psi', 'protein_id', 'conf'])
         af_phi_psi.to_csv(ins.outdir / 'af_phi_psi.csv', index=False)
     else:
@@ -5,9 +5,9 @@
 
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
 
 def fit_linregr(ins):
+    import statsmodels.api as sm
     ins.grouped_preds = ins.grouped_preds.sort_values('protein_id')
     ins.grouped_preds_da = ins.grouped_preds_da.sort_values('protein_id')
     X = ins.grouped_preds_da.values
@@ -4,12 +4,13 @@
 ###############################################
 
 from Bio import SeqIO
-import requests
+from lib.http_client import http_get, http_post
 from pathlib import Path
 import json
 import time
 from tqdm import tqdm
 import pandas as pd
+from lib.schema import apply_schema, PDBMINE_RESULTS_DTYPES, PDBMINE_WINDOW_DTYPES
 
 def query_and_process_pdbmine(ins):
     if not ins.match_outdir.exists() or len(list(ins.match_outdir.iterdir())) == 0:
@@ -37,7 +38,7 @@ def query_pdbmine(ins):
         if len(chain) < ins.winsize: # in case the last chain is too short
             continue
 
-        response = requests.post(
+        response = http_post(
             ins.pdbmine_url + '/v1/api/query',
             json={
                 "residueChain": chain,
@@ -45,14 +46,15 @@ def query_pdbmine(ins):
                 "windowSize": ins.winsize
             }
         )
-        assert(response.ok)
+        response.raise_for_status()
         print(response.json())
         query_id = response.json().get('queryID')
-        assert(query_id)
+        if not query_id:
+            raise ValueError(f'PDBMine returned no query ID: {response.json()}')
 
         time.sleep(60)
         while(True):
-            response = requests.get(ins.pdbmine_url + f'/v1/api/query/{query_id}')
+            response = http_get(ins.pdbmine_url + f'/v1/api/query/{query_id}')
             if response.ok and response.json().get('frames'):
                 matches = response.json()['frames']
                 break
@@ -84,7 +86,7 @@ def get_phi_psi_mined(ins):
                     phi_psi_mined.append([seq, res, phi, psi, chain, protein_id])
     phi_psi_mined = pd.DataFrame(phi_psi_mined, columns=['seq', 'res', 'phi', 'psi', 'chain', 'protein_id'])
     phi_psi_mined['weight'] = ins.weight
-    return phi_psi_mined
+    return apply_schema(phi_psi_mined, PDBMINE_RESULTS_DTYPES)
 
 def get_phi_psi_mined_window(ins):
     seqs = []
@@ -113,4 +115,4 @@ def get_phi_psi_mined_window(ins):
                     match_id += 1
 
     phi_psi_mined_window = pd.DataFrame(rows, columns=['seq', 'res', 'match_id', 'window_pos', 'phi', 'psi', 'chain', 'protein_id'])
-    return phi_psi_mined_window
\ No newline at end of file
+    return apply_schema(phi_psi_mined_window, PDBMINE_WINDOW_DTYPES)
\ No newline at end of file
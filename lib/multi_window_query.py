@@ -4,11 +4,13 @@
 ###############################################
 
 from pathlib import Path
+from functools import cached_property
 from lib.retrieve_data import retrieve_pdb_file, retrieve_alphafold_prediction
 from lib.utils import get_seq_funcs
 from lib import PDBMineQuery
 from lib.modules import get_phi_psi_xray, get_phi_psi_af
-import requests
+from lib.http_client import http_get
+from requests.exceptions import RequestException
 import pandas as pd
 import time
 
@@ -25,28 +27,49 @@ class MultiWindowQuery:
         else:
             self.outdir.mkdir(exist_ok=False, parents=True)
 
-        self.xray_fn, self.sequence = retrieve_pdb_file(self.pdb_code)
-        self.af_fn = retrieve_alphafold_prediction(self.pdb_code)
 
         _, self.get_center, self.get_seq_ctxt = get_seq_funcs(self.winsize_ctxt)
 
         self.xray_phi_psi = None
         self.af_phi_psi = None
-        self.queries = []
+        self.angle_arrays = {}
+        self.match_outdir = match_outdir
+        self.kdews = [1] * len(winsizes)
+        self.queried = False
+
+    # The xray, AlphaFold prediction and queries are only retrieved/built on first use
+    @cached_property
+    def xray_info(self):
+        return retrieve_pdb_file(self.pdb_code)
+
+    @cached_property
+    def xray_fn(self):
+        return self.xray_info[0]
+
+    @cached_property
+    def sequence(self):
+        return self.xray_info[1]
 
+    @cached_property
+    def af_fn(self):
+        return retrieve_alphafold_prediction(self.pdb_code)
+
+    @cached_property
+    def queries(self):
+        queries = []
         for i,winsize in enumerate(self.winsizes):
-            self.queries.append(PDBMineQuery(
+            queries.append(PDBMineQuery(
                 self.casp_protein_id, self.pdb_code, winsize, self.pdbmine_url,
-                self.sequence, 1, match_outdir
+                self.sequence, self.kdews[i], self.match_outdir
             ))
-            self.queries[-1].set_get_subseq(self.winsize_ctxt)
-        self.queried = False
+            queries[-1].set_get_subseq(self.winsize_ctxt)
+        return queries
 
-    def compute_structure(self, replace=False):
-        self.xray_phi_psi = get_phi_psi_xray(self, replace)
+    def compute_structure(self, replace=False, validate=False):
+        self.xray_phi_psi = get_phi_psi_xray(self, replace, validate)
         self.xray_phi_psi = self.xray_phi_psi[~self.xray_phi_psi.phi.isna() & ~self.xray_phi_psi.psi.isna()]
         if self.af_fn is not None:
-            self.af_phi_psi = get_phi_psi_af(self, replace)
+            self.af_phi_psi = get_phi_psi_af(self, replace, validate)
         self.seqs = self.xray_phi_psi.seq_ctxt.unique()
 
     def compute_af_structure(self, replace=False):
@@ -55,7 +78,11 @@ class MultiWindowQuery:
         else:
             print('No alphafold prediction found')
     def test_pdbmine_conn(self):
-        response = requests.get(self.pdbmine_url + f'/v1/api/protein/{self.pdb_code}')
+        try:
+            response = http_get(self.pdbmine_url + f'/v1/api/protein/{self.pdb_code}')
+        except RequestException as e:
+            print('PDBMine Connection:', type(e).__name__)
+            return False
         print('PDBMine Connection:', response.status_code)
         return response.ok
 
@@ -6,7 +6,8 @@
 from lib.modules import query_and_process_pdbmine
 from pathlib import Path
 from lib.utils import get_seq_funcs, get_subseq_func
-import pandas as pd
+from lib.across_window_utils import build_match_arrays
+from lib.schema import read_table, PDBMINE_RESULTS_DTYPES, PDBMINE_WINDOW_DTYPES
 
 # Class to represent a PDBMine query for a certain sequence and window size
 class PDBMineQuery():
@@ -23,6 +24,7 @@ class PDBMineQuery():
         
         self.results = None
         self.results_window = None
+        self.match_arrays = None
     
     def get_center_idx_pos(self):
         center_idx = self.get_center_idx()
@@ -32,6 +34,12 @@ class PDBMineQuery():
     
     def set_get_subseq(self, winsize_ctxt):
         self.get_subseq = get_subseq_func(self.winsize, winsize_ctxt)
+
+    def get_match_arrays(self):
+        # Dense match arrays of results_window, rebuilt if results_window is replaced
+        if self.match_arrays is None or self.match_arrays[0] is not self.results_window:
+            self.match_arrays = (self.results_window, *build_match_arrays(self))
+        return self.match_arrays[1:]
     def query_and_process_pdbmine(self, outdir):
         self.results, self.results_window = query_and_process_pdbmine(self)
         self.results = self.results[(self.results.phi <= 180) & (self.results.psi <= 180)]
@@ -40,6 +48,6 @@ class PDBMineQuery():
         self.results_window.to_csv(outdir / f'phi_psi_mined_window_win{self.winsize}.csv', index=False)
     
     def load_results(self, outdir):
-        self.results = pd.read_csv(outdir / f'phi_psi_mined_win{self.winsize}.csv')
-        self.results_window = pd.read_csv(outdir / f'phi_psi_mined_window_win{self.winsize}.csv')
+        self.results = read_table(outdir / f'phi_psi_mined_win{self.winsize}.csv', PDBMINE_RESULTS_DTYPES)
+        self.results_window = read_table(outdir / f'phi_psi_mined_window_win{self.winsize}.csv', PDBMINE_WINDOW_DTYPES)
         self.results_window = self.results_window[(self.results_window.phi <= 180) & (self.results_window.psi <= 180)]
\ No newline at end of file
@@ -15,7 +15,7 @@ from lib.utils import calc_da, calc_da_for_one, get_phi_psi_dist
 from lib.across_window_utils import (
     get_combined_phi_psi_dist, get_xrays_window, get_afs_window, 
     get_preds_window, precompute_dists, find_clusters, 
-    filter_precomputed_dists, get_cluster_medoid
+    filter_precomputed_dists, get_cluster_medoids, get_window_clusters
 )
 from matplotlib.patches import ConnectionPatch
 
@@ -527,24 +527,31 @@ def plot_across_window_clusters(ins, seq_ctxt, plot_xrays, plot_afs, n_cluster_l
     preds = get_preds_window(ins, q, seq_ctxt)
     afs = get_afs_window(ins, q, seq_ctxt)
 
-    precomputed_dists = precompute_dists(phi_psi_dist_v)
-    n_clusters, clusters = find_clusters(precomputed_dists, 20)
-    precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+    cached = get_window_clusters(ins, seq_ctxt, 20)
+    if cached is not None and cached['labels'].shape[0] == phi_psi_dist_v.shape[0]:
+        # reuse the clustering from compute_das
+        clusters = cached['labels']
+        phi_psi_dist_v = phi_psi_dist_v[clusters != -1]
+        clusters = clusters[clusters != -1]
+        cluster_medoids = cached['cluster_ids'], cached['medoids'], cached['cluster_counts']
+    else:
+        precomputed_dists = precompute_dists(phi_psi_dist_v)
+        n_clusters, clusters = find_clusters(precomputed_dists, 20)
+        precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+        cluster_medoids = get_cluster_medoids(phi_psi_dist_v, precomputed_dists, clusters)
 
-    def plot(q, seq_ctxt, xrays, afs, clusters, phi_psi_dist, precomputed_dists):
+    def plot(q, seq_ctxt, xrays, afs, clusters, phi_psi_dist, cluster_medoids):
         n_cluster_plot = 10
         n_clusters = len(np.unique(clusters))
         xrays = xrays.reshape(2, -1)
         afs = afs.reshape(2, -1)
         print(pd.Series(clusters).value_counts())
 
-        cluster_points = phi_psi_dist.groupby(clusters).count().sort_values('phi_0', ascending=False).index.values
+        unique_clusters, medoids, cluster_counts = cluster_medoids
+        largest = np.argsort(-cluster_counts, kind='stable')
+        cluster_points = unique_clusters[largest]
         clusters_plot = cluster_points[:n_cluster_plot]
-        medoids = []
-        for cluster in cluster_points:
-            medoid = get_cluster_medoid(phi_psi_dist, precomputed_dists, clusters, cluster)
-            medoids.append(medoid)
-        medoids = np.array(medoids)
+        medoids = medoids[largest]
 
         colors = sns.color_palette('Dark2', n_clusters)
         fig, axes = plt.subplots(len(clusters_plot), q.winsize, figsize=(16, min(n_cluster_plot, len(clusters_plot))*4), sharey=True, sharex=True)
@@ -600,7 +607,7 @@ def plot_across_window_clusters(ins, seq_ctxt, plot_xrays, plot_afs, n_cluster_l
         plt.tight_layout()
         plt.show()
     
-    plot(q, seq_ctxt, xrays, afs, clusters, phi_psi_dist_v, precomputed_dists)
+    plot(q, seq_ctxt, xrays, afs, clusters, phi_psi_dist_v, cluster_medoids)
 
 def plot_across_window_cluster_medoids(ins, seq_ctxt, plot_xrays=False, plot_afs=False, verbose=False, mode_scatter=False, cse=30, fn=None):
     _, info = get_phi_psi_dist(ins.queries, seq_ctxt)
@@ -614,26 +621,36 @@ def plot_across_window_cluster_medoids(ins, seq_ctxt, plot_xrays=False, plot_afs
     # preds = get_preds_window(ins, q, seq_ctxt)
     # afs = get_afs_window(ins, q, seq_ctxt)
 
-    precomputed_dists = precompute_dists(phi_psi_dist_v)
-    n_clusters, clusters = find_clusters(precomputed_dists, 20, cse)
+    cached = get_window_clusters(ins, seq_ctxt, 20, cse)
+    use_cached = cached is not None and cached['labels'].shape[0] == phi_psi_dist_v.shape[0]
+    if use_cached:
+        # reuse the clustering from compute_das
+        clusters = cached['labels']
+        n_clusters = cached['cluster_ids'].shape[0]
+    else:
+        precomputed_dists = precompute_dists(phi_psi_dist_v)
+        n_clusters, clusters = find_clusters(precomputed_dists, 20, cse)
     if verbose:
         print(f'Number of clusters: {n_clusters}')
     if n_clusters == 0:
         print('No clusters found')
         return
-    precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+    if use_cached:
+        phi_psi_dist_v = phi_psi_dist_v[clusters != -1]
+        clusters = clusters[clusters != -1]
+        cluster_medoids = cached['cluster_ids'], cached['medoids'], cached['cluster_counts']
+    else:
+        precomputed_dists, phi_psi_dist_v, clusters = filter_precomputed_dists(precomputed_dists, phi_psi_dist_v, clusters)
+        cluster_medoids = get_cluster_medoids(phi_psi_dist_v, precomputed_dists, clusters)
     print(phi_psi_dist_v.shape)
 
-    def plot(q, phi_psi_dist, precomputed_dists, clusters, seq_ctxt):
+    def plot(q, phi_psi_dist, cluster_medoids, clusters, seq_ctxt):
         seq = q.get_subseq(seq_ctxt)
-        unique_clusters, cluster_counts = np.unique(clusters, return_counts=True)
-        medoids = []
-        for cluster in unique_clusters:
-            medoid = get_cluster_medoid(phi_psi_dist, precomputed_dists, clusters, cluster)
-            medoids.append(medoid)
-            if verbose:
-                print(f'Cluster {cluster} has {cluster_counts[cluster]} members and medoid {medoid}')
-        medoids = np.array(medoids).reshape(unique_clusters.shape[0], 2, -1)
+        unique_clusters, medoids, cluster_counts = cluster_medoids
+        if verbose:
+            for cluster, count, medoid in zip(unique_clusters, cluster_counts, medoids):
+                print(f'Cluster {cluster} has {count} members and medoid {medoid}')
+        medoids = medoids.reshape(unique_clusters.shape[0], 2, -1)
 
         fig, axes = plt.subplots(1, q.winsize, figsize=(q.winsize*3,3.5), sharey=True)
         colors = sns.color_palette('Dark2', len(unique_clusters))
@@ -717,4 +734,4 @@ def plot_across_window_cluster_medoids(ins, seq_ctxt, plot_xrays=False, plot_afs
         else:
             plt.show()
         
-    plot(q, phi_psi_dist_v, precomputed_dists, clusters, seq_ctxt)
\ No newline at end of file
+    plot(q, phi_psi_dist_v, cluster_medoids, clusters, seq_ctxt)
\ No newline at end of file
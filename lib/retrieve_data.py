@@ -4,13 +4,18 @@
 ###############################################
 
 import pandas as pd
-import requests
+from lib.http_client import http_get
 from pathlib import Path
 import re
 from Bio.PDB import PDBList
 import os
 from Bio import SeqIO
 import warnings
+import json
+import argparse
+import io
+import tarfile
+from functools import lru_cache
 
 TARGETLIST_URL = 'https://predictioncenter.org/casp14/targetlist.cgi?type=csv'
 PREDICTIONS_URL = 'https://predictioncenter.org/download_area/CASP14/predictions/regular/{casp_protein_id}.tar.gz'
@@ -19,12 +24,57 @@ RESULTS_URL = 'https://predictioncenter.org/download_area/CASP14/results/tables/
 
 # def_retrieve_data():
 
+# Local data store - every file is kept under DATA_ROOT (PDBMINE_DATA_ROOT, default: the working directory),
+# with the sequences and UniProt/AlphaFold lookups recorded in its index. With OFFLINE (PDBMINE_OFFLINE=1)
+# only the store is used and nothing is downloaded; fill it beforehand with prefetch()
+DATA_ROOT = Path(os.environ.get('PDBMINE_DATA_ROOT', '.'))
+OFFLINE = os.environ.get('PDBMINE_OFFLINE', '0') == '1'
+STORE_INDEX_FN = 'data_index.json'
+_store_index = None
+_targetlist = None
+
+def set_data_root(root=None, offline=None):
+    global DATA_ROOT, OFFLINE, _store_index, _targetlist
+    if root is not None:
+        DATA_ROOT = Path(root)
+        _store_index = None
+        _targetlist = None
+    if offline is not None:
+        OFFLINE = offline
+
+def get_data_path(*parts):
+    return DATA_ROOT.joinpath(*parts)
+
+def load_store_index():
+    global _store_index
+    if _store_index is None:
+        _store_index = {'pdb': {}, 'uniprot': {}, 'alphafold': {}}
+        if get_data_path(STORE_INDEX_FN).exists():
+            with open(get_data_path(STORE_INDEX_FN)) as f:
+                _store_index.update(json.load(f))
+    return _store_index
+
+def save_store_index():
+    DATA_ROOT.mkdir(exist_ok=True, parents=True)
+    tmp = get_data_path(STORE_INDEX_FN + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(load_store_index(), f, indent=1)
+    os.replace(tmp, get_data_path(STORE_INDEX_FN))
+
+def check_online(what):
+    if OFFLINE:
+        raise ValueError(f'{what} not found in the local data store ({DATA_ROOT}) and downloads are disabled')
 
 def retrieve_target_list():
-    targetlist_file = Path('targetlist.csv')
+    global _targetlist
+    if _targetlist is not None:
+        return _targetlist
+    targetlist_file = get_data_path('targetlist.csv')
     if not targetlist_file.exists():
+        check_online('CASP target list')
+        DATA_ROOT.mkdir(exist_ok=True, parents=True)
         with open(targetlist_file, 'wb') as f:
-            f.write(requests.get(TARGETLIST_URL).content)
+            f.write(http_get(TARGETLIST_URL).content)
     targetlist = pd.read_csv(targetlist_file, sep=';').set_index('Target')
 
     def re_pdb_code(x):
@@ -42,37 +92,125 @@ def retrieve_target_list():
     #     return m.group() if m else ''
     targetlist['pdb_code'] = targetlist.apply(re_pdb_code, axis=1)
 
+    _targetlist = targetlist
     return targetlist
 
 def retrieve_pdb_file(pdb_code):
-    pdbl = PDBList()
-    xray_fn = pdbl.retrieve_pdb_file(pdb_code, pdir='pdb', file_format='pdb', obsolete=False)
+    index = load_store_index()['pdb']
+    entry = index.get(pdb_code.lower())
+    if entry is not None and get_data_path(entry['fn']).exists():
+        return str(get_data_path(entry['fn'])), entry['sequence']
+
+    xray_fn = get_data_path('pdb', f'pdb{pdb_code.lower()}.ent')
+    if not xray_fn.exists():
+        check_online(f'PDB file {pdb_code}')
+        pdbl = PDBList()
+        xray_fn = Path(pdbl.retrieve_pdb_file(pdb_code, pdir=get_data_path('pdb'), file_format='pdb', obsolete=False))
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
         record = next(iter(SeqIO.parse(xray_fn, "pdb-seqres")))
         residue_chain = str(record.seq)
-    return xray_fn, residue_chain
+    index[pdb_code.lower()] = {'fn': str(xray_fn.relative_to(DATA_ROOT)), 'sequence': residue_chain}
+    save_store_index()
+    return str(xray_fn), residue_chain
 
-def retrieve_casp_predictions(casp_protein_id, is_domain):
+def retrieve_casp_predictions(casp_protein_id, is_domain, extract=False):
+    # Path of the target's prediction models: its extracted directory if there is one, otherwise the
+    # downloaded tarball, which is read in place (see iter_predictions) unless extract is set
     if is_domain:
         predictions_url = PREDICTIONS_DOMAIN_URL.format(casp_protein_id=casp_protein_id)
     else:
         predictions_url = PREDICTIONS_URL.format(casp_protein_id=casp_protein_id)
-    predictions_dir = Path(f'./casp-predictions/')
-    if not (predictions_dir / casp_protein_id).exists():
-        predictions_dir.mkdir(exist_ok=True)
-        os.system(f'wget -O {predictions_dir}/{casp_protein_id}.tar.gz {predictions_url}')
-        os.system(f'tar -xvf {predictions_dir}/{casp_protein_id}.tar.gz -C {predictions_dir}')
-    # Return path to the extracted directory
-    return predictions_dir / casp_protein_id
+    predictions_dir = get_data_path('casp-predictions')
+    if (predictions_dir / casp_protein_id).exists():
+        return predictions_dir / casp_protein_id
+    tarball = predictions_dir / f'{casp_protein_id}.tar.gz'
+    if not tarball.exists():
+        check_online(f'CASP predictions for {casp_protein_id}')
+        predictions_dir.mkdir(exist_ok=True, parents=True)
+        download_file(predictions_url, tarball)
+    if extract:
+        with tarfile.open(tarball) as tar:
+            tar.extractall(predictions_dir, filter='data')
+        return predictions_dir / casp_protein_id
+    return tarball
 
-def retrieve_casp_results(casp_protein_id):
-    results_dir = Path('casp-results')
+def download_file(url, fn):
+    # Stream a download to disk, only moving it into place once complete
+    tmp = Path(str(fn) + '.part')
+    with http_get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(tmp, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    os.replace(tmp, fn)
+
+def is_tarball(path):
+    return Path(path).name.endswith(('.tar.gz', '.tgz', '.tar'))
+
+def get_tarball(fn):
+    # The tarball a prediction path (tarball/model) points into, None for plain files
+    fn = Path(fn)
+    return fn.parent if is_tarball(fn.parent) else None
+
+def iter_predictions(predictions_dir):
+    # (path, bytes) of every prediction model of a directory or a tarball - tarballs are streamed
+    # member by member, never extracted, and their models get tarball/model paths
+    predictions_dir = Path(predictions_dir)
+    if not is_tarball(predictions_dir):
+        for fn in predictions_dir.iterdir():
+            yield fn, fn.read_bytes()
+        return
+    with tarfile.open(predictions_dir, 'r|*') as tar:
+        for member in tar:
+            if member.isfile():
+                yield predictions_dir / Path(member.name).name, tar.extractfile(member).read()
+
+def list_predictions(predictions_dir):
+    predictions_dir = Path(predictions_dir)
+    if not is_tarball(predictions_dir):
+        return list(predictions_dir.iterdir())
+    return [predictions_dir / name for name in get_tarball_index(predictions_dir)]
+
+@lru_cache(maxsize=8)
+def load_tarball_index(tarball, mtime_ns):
+    # Model name -> TarInfo (header only, no data) of every model of a tarball, for random access to single models
+    with tarfile.open(tarball) as tar:
+        return {Path(member.name).name: member for member in tar.getmembers() if member.isfile()}
+
+def get_tarball_index(tarball):
+    return load_tarball_index(str(tarball), os.stat(tarball).st_mtime_ns)
+
+def read_prediction(fn):
+    # Contents of a prediction model file, or of a model inside a tarball
+    tarball = get_tarball(fn)
+    if tarball is None:
+        return Path(fn).read_bytes()
+    index = get_tarball_index(tarball)
+    if Path(fn).name not in index:
+        raise FileNotFoundError(f'{Path(fn).name} not found in {tarball}')
+    with tarfile.open(tarball) as tar:
+        return tar.extractfile(index[Path(fn).name]).read()
+
+def open_prediction(fn):
+    # Text handle of a prediction model, for parsers
+    if get_tarball(fn) is None:
+        return open(fn)
+    return io.StringIO(read_prediction(fn).decode())
+
+def retrieve_casp_results_tables():
+    results_dir = get_data_path('casp-results')
     if not results_dir.exists():
-        results_dir.mkdir(exist_ok=True)
-        os.system(f'wget -O {results_dir / "casp14.res_tables.T.tar.gz"} {RESULTS_URL}')
-        os.system(f'tar -xvf {results_dir / "casp14.res_tables.T.tar.gz"} -C {results_dir}')
+        check_online('CASP results tables')
+        results_dir.mkdir(exist_ok=True, parents=True)
+        download_file(RESULTS_URL, results_dir / 'casp14.res_tables.T.tar.gz')
+        with tarfile.open(results_dir / 'casp14.res_tables.T.tar.gz') as tar:
+            tar.extractall(results_dir, filter='data')
+    return results_dir
+
+def retrieve_casp_results(casp_protein_id):
+    results_dir = retrieve_casp_results_tables()
     results_file = results_dir / f'{casp_protein_id}.txt'
     # some files are named differently
     if not results_file.exists():
@@ -84,31 +222,57 @@ def retrieve_casp_results(casp_protein_id):
     return results
 
 def retrieve_alphafold_prediction(pdb_code):
-    af_dir = Path('alphafold_predictions')
-    response = requests.get(f'https://www.ebi.ac.uk/pdbe/api/mappings/uniprot/{pdb_code}')
-    if not response.ok:
+    # Lookups that found nothing (404) are recorded in the store index too, so they are not repeated
+    af_dir = get_data_path('alphafold_predictions')
+    index = load_store_index()
+    fn = af_dir / (pdb_code + '.pdb')
+    if fn.exists():
+        return fn
+    if index['alphafold'].get(pdb_code, '') is None:
+        print('No prediction found in AlphaFold DB for', pdb_code)
+        return None
+    if OFFLINE:
+        print(f'No AlphaFold prediction for {pdb_code} in the local data store')
+        return None
+
+    uniprot_id = index['uniprot'].get(pdb_code.lower(), '')
+    if uniprot_id == '':
+        response = http_get(f'https://www.ebi.ac.uk/pdbe/api/mappings/uniprot/{pdb_code}')
+        if not response.ok:
+            print('No UniProt mapping found for', pdb_code)
+            if response.status_code == 404:
+                index['uniprot'][pdb_code.lower()] = None
+                save_store_index()
+            return None
+        uniprot_id = list(response.json()[pdb_code.lower()]['UniProt'].keys())[0]
+        index['uniprot'][pdb_code.lower()] = uniprot_id
+        save_store_index()
+    if uniprot_id is None:
         print('No UniProt mapping found for', pdb_code)
         return None
-    uniprot_id = list(response.json()[pdb_code.lower()]['UniProt'].keys())[0]
     print('UniProt ID:', uniprot_id)
 
-    response = requests.get(f'https://alphafold.ebi.ac.uk/api/prediction/{uniprot_id}')
+    response = http_get(f'https://alphafold.ebi.ac.uk/api/prediction/{uniprot_id}')
     if not response.ok:
         print('No prediction found in AlphaFold DB for', pdb_code)
+        if response.status_code == 404:
+            index['alphafold'][pdb_code] = None
+            save_store_index()
         return None
     pdb_url = response.json()[0]['pdbUrl']
 
-    response = requests.get(pdb_url)
+    response = http_get(pdb_url)
     if not response.ok:
         print('Error retrieving AlphaFold PDB file for', pdb_code)
         return None
     pdb_data = response.text
 
     if not af_dir.exists():
-        af_dir.mkdir()
-    fn = af_dir / (pdb_code + '.pdb')
+        af_dir.mkdir(parents=True)
     with open(fn, 'w') as f:
         f.write(pdb_data)
+    index['alphafold'][pdb_code] = str(fn.relative_to(DATA_ROOT))
+    save_store_index()
     
     return fn
 
@@ -122,4 +286,44 @@ def get_pdb_code(casp_protein_id, targetlist):
     pdb_code = targetlist.loc[protein_id, 'pdb_code']
     if not pdb_code:
         raise ValueError(f'No PDB code found for {casp_protein_id}')
-    return pdb_code, is_domain
\ No newline at end of file
+    return pdb_code, is_domain
+
+def prefetch(casp_protein_ids=None, pdb_codes=None, results=True, alphafold=True):
+    # Download everything needed to analyse the given CASP targets and PDB codes into the local data store,
+    # so they can be constructed offline later (e.g. on compute nodes without network access)
+    casp_protein_ids = casp_protein_ids or []
+    pdb_codes = list(pdb_codes or [])
+    failed = []
+    if len(casp_protein_ids) > 0:
+        targetlist = retrieve_target_list()
+        if results:
+            retrieve_casp_results_tables()
+    for casp_protein_id in casp_protein_ids:
+        try:
+            pdb_code, is_domain = get_pdb_code(casp_protein_id, targetlist)
+            retrieve_casp_predictions(casp_protein_id, is_domain)
+            pdb_codes.append(pdb_code)
+        except Exception as e:
+            print(f'{casp_protein_id}: {type(e).__name__}: {e}')
+            failed.append(casp_protein_id)
+    for pdb_code in dict.fromkeys(pdb_codes):
+        try:
+            retrieve_pdb_file(pdb_code)
+            if alphafold:
+                retrieve_alphafold_prediction(pdb_code)
+        except Exception as e:
+            print(f'{pdb_code}: {type(e).__name__}: {e}')
+            failed.append(pdb_code)
+    print(f'Prefetched {len(casp_protein_ids)} CASP targets and {len(set(pdb_codes))} PDB entries into {DATA_ROOT} ({len(failed)} failed)')
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prefetch PDB, AlphaFold and CASP data into the local data store')
+    parser.add_argument('--root', default=None, help='data store root (default: PDBMINE_DATA_ROOT or the working directory)')
+    parser.add_argument('--casp', nargs='*', default=[], help='CASP target ids')
+    parser.add_argument('--pdb', nargs='*', default=[], help='PDB codes')
+    parser.add_argument('--no-results', action='store_true', help='skip the CASP results tables')
+    parser.add_argument('--no-alphafold', action='store_true', help='skip AlphaFold predictions')
+    args = parser.parse_args()
+    set_data_root(args.root, offline=False)
+    prefetch(args.casp, args.pdb, not args.no_results, not args.no_alphafold)
@@ -0,0 +1,75 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import numpy as np
+import pandas as pd
+
+# Column dtypes of the large tables - repeated strings as categoricals, angles as float32
+# Columns not listed (e.g. da columns added later) keep their dtypes
+PDBMINE_RESULTS_DTYPES = {
+    'seq': 'category',
+    'res': 'category',
+    'phi': np.float32,
+    'psi': np.float32,
+    'chain': 'category',
+    'protein_id': 'category',
+    'weight': np.float32,
+}
+PDBMINE_WINDOW_DTYPES = {
+    'seq': 'category',
+    'res': 'category',
+    'match_id': np.int32,
+    'window_pos': np.int8,
+    'phi': np.float32,
+    'psi': np.float32,
+    'chain': 'category',
+    'protein_id': 'category',
+}
+PREDICTIONS_DTYPES = {
+    'pos': np.int32,
+    'seq_ctxt': 'category',
+    'res': 'category',
+    'phi': np.float32,
+    'psi': np.float32,
+    'protein_id': 'category',
+    'kde_method': 'category',
+}
+
+def apply_schema(df, dtypes):
+    return df.astype({col: dtype for col,dtype in dtypes.items() if col in df.columns})
+
+def read_table(fn, dtypes):
+    # Strings are parsed straight into categoricals, without an intermediate object column
+    columns = pd.read_csv(fn, nrows=0).columns
+    return pd.read_csv(fn, dtype={col: dtype for col,dtype in dtypes.items() if col in columns})
+
+def to_default_dtypes(df):
+    # df with the dtypes pandas would give it without a schema (plain strings, float64, int64)
+    dtypes = {}
+    for col,dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[col] = dtype.categories.dtype
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[col] = np.float64
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[col] = np.int64
+    return df.astype(dtypes)
+
+def get_memory_usage(ins):
+    # Memory (MB) of the pdbmine matches and prediction angles of one target, as stored and with default dtypes
+    tables = [('phi_psi_predictions', None, ins.phi_psi_predictions)]
+    for q in ins.queries:
+        tables += [('results', q.winsize, q.results), ('results_window', q.winsize, q.results_window)]
+
+    usage = []
+    for table, winsize, df in tables:
+        if df is None:
+            continue
+        default_mb = to_default_dtypes(df).memory_usage(deep=True).sum() / 2**20
+        mb = df.memory_usage(deep=True).sum() / 2**20
+        usage.append([table, winsize, df.shape[0], default_mb, mb])
+    usage = pd.DataFrame(usage, columns=['table', 'winsize', 'rows', 'default_mb', 'mb'])
+    usage['reduction'] = usage['default_mb'] / usage['mb']
+    return usage
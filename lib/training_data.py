@@ -0,0 +1,100 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import contextlib
+import io
+import multiprocessing as mp
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from lib import MultiWindowQuery
+from lib.across_window_utils import get_xrays_window
+from lib.constants import AMINO_ACID_MAP
+from lib.modules.compute_das_window_ml import cluster_residue_window_ml
+from lib.window_executor import run_over_residues
+
+def get_window_training_data(ins, n_medoids=2):
+    # TransformerModel samples for every residue of a MultiWindowQuery with a complete xray window:
+    # X (R, n_medoids, 2*winsize) medoids of the largest clusters of the widest window's matches,
+    # xres (R, winsize) residue indices and y (R, winsize, 2) xray phi psi
+    q = ins.queries[-1]
+    residues = []
+    tasks = []
+    for seq_ctxt in ins.seqs:
+        if 'X' in seq_ctxt:
+            continue
+        xrays = get_xrays_window(ins, q, seq_ctxt)
+        if xrays.shape[0] != q.winsize*2:
+            continue
+        residues.append((seq_ctxt, xrays))
+        tasks.append((seq_ctxt, [ins.winsizes[-1]], n_medoids))
+
+    X, xres, y = [], [], []
+    for (seq_ctxt, xrays), result in zip(residues, run_over_residues(ins, cluster_residue_window_ml, tasks)):
+        if result['error'] is not None:
+            continue
+        X.append(result['medoids'])
+        xres.append([AMINO_ACID_MAP[r] for r in seq_ctxt])
+        y.append(xrays.reshape(2, q.winsize).T)
+    L = ins.winsizes[-1]
+    return (
+        np.array(X).reshape(-1, n_medoids, 2*L),
+        np.array(xres, dtype=np.int64).reshape(-1, L),
+        np.array(y).reshape(-1, L, 2)
+    )
+
+def process_protein(pdb_code, winsizes, pdbmine_url, projects_dir, match_outdir, n_medoids=2, verbose=False):
+    # Build one protein's samples, reusing its saved structures and pdbmine matches if they exist
+    # Returns (pdb_code, (X, xres, y) or None, error message or None)
+    out = io.StringIO()
+    try:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(out):
+            ins = MultiWindowQuery(pdb_code, winsizes, pdbmine_url, projects_dir, match_outdir=match_outdir)
+            ins.compute_structure()
+            ins.query_pdbmine()
+            data = get_window_training_data(ins, n_medoids)
+    except Exception:
+        return pdb_code, None, traceback.format_exc(limit=3)
+    return pdb_code, data, None
+
+def build_training_data(
+        pdb_codes, winsizes, pdbmine_url, dataset_path,
+        projects_dir='ml_data', match_outdir='cache', n_jobs=4, n_medoids=2, shard_size=16384, verbose=False
+    ):
+    # Generate TransformerModel training data for many proteins in a process pool, straight into a sharded dataset
+    # Proteins already in the dataset (or recorded as having no samples) are skipped, so an interrupted run
+    # can be restarted; proteins that raised are reported and retried on the next run
+    from lib.ml.datasets import ShardWriter
+    summary = []
+    with ShardWriter(dataset_path, shard_size) as writer:
+        todo = [pdb_code for pdb_code in pdb_codes if not writer.done(pdb_code)]
+        print(f'{len(pdb_codes) - len(todo)} proteins already done, {len(todo)} to process ({n_jobs} jobs)')
+
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(process_protein, pdb_code, winsizes, pdbmine_url, projects_dir, match_outdir, n_medoids, verbose)
+                for pdb_code in todo
+            ]
+            for i,future in enumerate(as_completed(futures)):
+                pdb_code, data, error = future.result()
+                n_samples = 0
+                if error is not None:
+                    print(f'{pdb_code}: failed\n{error}')
+                elif data[0].shape[0] == 0:
+                    writer.skip(pdb_code, 'no samples')
+                else:
+                    writer.add(pdb_code, *data)
+                    n_samples = data[0].shape[0]
+                hours = (time.time() - start) / 3600
+                print(f'{i+1}/{len(todo)} {pdb_code}: {n_samples} samples - {(i+1) / hours:.1f} proteins/hour')
+                summary.append([pdb_code, n_samples, error])
+
+    hours = (time.time() - start) / 3600
+    if len(todo) > 0:
+        print(f'Processed {len(todo)} proteins in {hours*60:.1f} min ({len(todo) / hours:.1f} proteins/hour)')
+    return pd.DataFrame(summary, columns=['pdb_code', 'n_samples', 'error'])
@@ -5,18 +5,18 @@
 
 from Bio import SeqIO
 import warnings
-from Bio.PDB import Superimposer, PDBParser
+from Bio.PDB import PDBParser
+from Bio.SVDSuperimposer import SVDSuperimposer
 from Bio.Align import PairwiseAligner
-from scipy.stats import gaussian_kde
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from scipy.stats import pearsonr, linregress
 import pandas as pd
 import numpy as np
 from lib.constants import AMINO_ACID_CODES
-from lib.ml.utils import get_ml_pred
+from lib.retrieve_data import get_tarball, read_prediction, open_prediction
 from pathlib import Path
-from sklearn.cluster import KMeans, MeanShift, estimate_bandwidth
+import hashlib
+import os
+from functools import lru_cache
+from collections import OrderedDict
 
 def get_seq_funcs(winsize_ctxt):
     def get_center_idx():
@@ -68,7 +68,8 @@ def check_alignment(xray_fn, pred_fn):
         record = next(iter(SeqIO.parse(xray_fn, "pdb-seqres")))
         residue_chain = str(record.seq)#[residue_range[0]-1:residue_range[1]]
 
-        pred_seq = str(next(iter(SeqIO.parse(pred_fn, "pdb-atom"))).seq)
+        with open_prediction(pred_fn) as f:
+            pred_seq = str(next(iter(SeqIO.parse(f, "pdb-atom"))).seq)
 
         aligner = PairwiseAligner()
         aligner.mode = 'global'
@@ -82,6 +83,7 @@ def check_alignment(xray_fn, pred_fn):
                 print(f'Match of length: {t2-t1} residues at position t={t1}, q={q1}')
 
 def find_kdepeak(phi_psi_dist, bw_method, return_prob=False):
+    from scipy.stats import gaussian_kde
     # Find probability of each point
     phi_psi_dist = phi_psi_dist.loc[~phi_psi_dist[['phi', 'psi']].isna().any(axis=1)]
 
@@ -114,6 +116,7 @@ def find_kdepeak_af(phi_psi_dist, bw_method, af, return_peaks=False, find_peak=f
     phi_psi_dist = phi_psi_dist.loc[~phi_psi_dist[['phi', 'psi']].isna().any(axis=1)]
 
     # Find clusters
+    from sklearn.cluster import MeanShift
     bandwidth = 100
     ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
     ms.fit(phi_psi_dist[['phi','psi']])
@@ -156,24 +159,77 @@ def get_ml_pred_wrapper(phi_psi_dist, winsizes, res, af, ml, bw_method):
     peaks = []
     for w in winsizes:
         x = phi_psi_dist.loc[phi_psi_dist.winsize == w, ['phi', 'psi']].values.T
-        if x.shape[1] < 3:
-            if x.shape[1] == 0:
-                peaks.append([0,0])
-            else:
-                peaks.append(x.mean(axis=1).tolist())
-            continue
-        kde = gaussian_kde(x, bw_method=0.5)
-        # print(kde.cho_cov)
-        phi_grid, psi_grid = np.meshgrid(np.linspace(-180, 180, 180), np.linspace(-180, 180, 180))
-        grid = np.vstack([phi_grid.ravel(), psi_grid.ravel()])
-        probs = kde(grid).reshape(phi_grid.shape)
-        # print(probs)
-        kdepeak = grid[:,probs.argmax()]
-        peaks.append(kdepeak.tolist())
+        peaks.append(get_kde_peak(x))
     peaks = np.array(peaks)
+    from lib.ml.utils import get_ml_pred
     pred = get_ml_pred(peaks, res, af, ml)
     return pd.Series({'phi': pred[0], 'psi': pred[1]})
 
+def get_kde_peak(x, bw_method=0.5):
+    # Peak of the kde of x (2 x n) on a 180 x 180 grid - the ML model input for one window size
+    if x.shape[1] < 3:
+        if x.shape[1] == 0:
+            return [0,0]
+        return x.mean(axis=1).tolist()
+    from scipy.stats import gaussian_kde
+    kde = gaussian_kde(x, bw_method=bw_method)
+    phi_grid, psi_grid = np.meshgrid(np.linspace(-180, 180, 180), np.linspace(-180, 180, 180))
+    grid = np.vstack([phi_grid.ravel(), psi_grid.ravel()])
+    probs = kde(grid).reshape(phi_grid.shape)
+    kdepeak = grid[:,probs.argmax()]
+    return kdepeak.tolist()
+
+def get_kde_peaks_binned(xs, bw_method=0.5, n_bins=180, chunk_size=256):
+    # Approximate get_kde_peak for many point sets (each n x 2) at once
+    # Each set is binned on a periodic n_bins x n_bins grid and convolved by FFT with a wrapped
+    # gaussian of its own bandwidth-scaled covariance, so no KDE is evaluated point by point
+    # Peaks are bin centers; ok is False where the covariance is singular (gaussian_kde would fail)
+    peaks = np.zeros((len(xs), 2))
+    ok = np.ones(len(xs), dtype=bool)
+    width = 360 / n_bins
+    centers = -180 + width * (np.arange(n_bins) + 0.5)
+    offsets = width * np.fft.fftfreq(n_bins, 1 / n_bins)
+    kde_idx = []
+    for k,x in enumerate(xs):
+        if x.shape[0] < 3:
+            peaks[k] = get_kde_peak(x.T)
+        else:
+            kde_idx.append(k)
+
+    for c in range(0, len(kde_idx), chunk_size):
+        chunk = kde_idx[c:c+chunk_size]
+        B = len(chunk)
+        points = np.concatenate([xs[k] for k in chunk])
+        g = np.concatenate([np.full(xs[k].shape[0], b) for b,k in enumerate(chunk)])
+        n = np.bincount(g, minlength=B)
+
+        # covariance of each set, scaled by the bandwidth factor as in gaussian_kde
+        mean = np.stack([np.bincount(g, points[:,i], B) for i in range(2)], axis=1) / n[:,np.newaxis]
+        d = points - mean[g]
+        c00, c01, c11 = [np.bincount(g, d[:,i]*d[:,j], B) / (n - 1) * bw_method**2 for i,j in [(0,0), (0,1), (1,1)]]
+        det = c00 * c11 - c01**2
+        singular = ~(det > 1e-12 * np.maximum(c00 * c11, 1e-300))
+        det[singular] = 1
+
+        # wrapped gaussian kernel for each set on the periodic offset grid
+        a, b_, cc = c11 / det, -c01 / det, c00 / det
+        dphi, dpsi = offsets[:,np.newaxis], offsets[np.newaxis,:]
+        kernel = np.exp(-0.5 * (
+            a[:,None,None] * dphi**2 + 2 * b_[:,None,None] * dphi * dpsi + cc[:,None,None] * dpsi**2
+        ))
+
+        # histogram of each set, phi on the first axis
+        bins = np.floor((points + 180) / width).astype(int) % n_bins
+        hist = np.bincount(
+            (g * n_bins + bins[:,0]) * n_bins + bins[:,1], minlength=B * n_bins * n_bins
+        ).reshape(B, n_bins, n_bins)
+
+        density = np.fft.irfft2(np.fft.rfft2(hist) * np.fft.rfft2(kernel), s=(n_bins, n_bins))
+        argmax = density.reshape(B, -1).argmax(axis=1)
+        peaks[chunk] = np.stack([centers[argmax // n_bins], centers[argmax % n_bins]], axis=1)
+        ok[np.array(chunk)[singular]] = False
+    return peaks, ok
+
 def calc_da_for_one(kdepeak, phi_psi):
     diff = lambda x1, x2: min(abs(x1 - x2), 360 - abs(x1 - x2))
     return np.sqrt(diff(phi_psi[0], kdepeak[0])**2 + diff(phi_psi[1], kdepeak[1])**2)
@@ -185,82 +241,397 @@ def calc_da(kdepeak, phi_psi_preds):
     return np.sqrt(diff(phi_psi_preds[:,0], kdepeak[0])**2 + diff(phi_psi_preds[:,1], kdepeak[1])**2)
 
 
-def get_aligned_atoms(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True):
-    # Compute RMSD between two structures
+@lru_cache(maxsize=256)
+def load_structure_ca(fn, mtime_ns):
+    # One letter sequence, residue names and (L, 3) CA coordinates (nan where missing) of a structure's first chain
     pdb_parser = PDBParser()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        structureA = pdb_parser.get_structure('', fnA)
-        structureB = pdb_parser.get_structure('', fnB)
-    
-    chainA = next(iter(structureA[0].get_chains()))
-    chainB = next(iter(structureB[0].get_chains()))
+        with open_prediction(fn) as f:
+            structure = pdb_parser.get_structure('', f)
+    chain = next(iter(structure[0].get_chains()))
+    residues = list(chain.get_residues())
+    seq = ''.join([AMINO_ACID_CODES.get(r.resname, 'X') for r in residues])
+    resnames = np.array([r.resname for r in residues])
+    ca = np.full((len(residues), 3), np.nan)
+    for i,r in enumerate(residues):
+        if 'CA' in r:
+            ca[i] = r['CA'].coord
+    ca.setflags(write=False)
+    return seq, resnames, ca
+
+def get_structure_ca(fn):
+    # Cached by path and modification time, so each file is parsed once while it is unchanged
+    return load_structure_ca(str(fn), os.stat(get_tarball(fn) or fn).st_mtime_ns)
+
+@lru_cache(maxsize=1024)
+def get_alignment(seqA, seqB):
+    aligner = PairwiseAligner()
+    aligner.mode = 'global'
+    return aligner.align(seqA, seqB)[0]
+
+def get_aligned_coords(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True):
+    # CA coordinates (n, 3) of the residue pairs aligned between two structures, from the structure cache
+    idxA, idxB = get_aligned_indices(fnA, fnB, startA, endA, startB, endB, print_alignment)
+    return get_structure_ca(fnA)[2][idxA], get_structure_ca(fnB)[2][idxB]
+
+def get_aligned_indices(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True):
+    # Residue indices into each structure's first chain of the aligned pairs that both have a CA
+    seqA, resnamesA, caA = get_structure_ca(fnA)
+    seqB, resnamesB, caB = get_structure_ca(fnB)
 
     startA = startA or 0
-    endA = endA or len(chainA)
+    endA = endA or len(seqA)
     startB = startB or 0
-    endB = endB or len(chainB)
+    endB = endB or len(seqB)
 
-    residuesA = ''.join([AMINO_ACID_CODES.get(r.resname, 'X') for r in chainA.get_residues()])[startA:endA]
-    residuesB = ''.join([AMINO_ACID_CODES.get(r.resname, 'X') for r in chainB.get_residues()])[startB:endB]
-    aligner = PairwiseAligner()
-    aligner.mode = 'global'
-    alignments =  aligner.align(residuesA, residuesB)
+    alignment = get_alignment(seqA[startA:endA], seqB[startB:endB])
     if print_alignment:
-        print(alignments[0])
-
-    atomsA = []
-    atomsB = []
-    residuesA = list(chainA.get_residues())[startA:endA]
-    residuesB = list(chainB.get_residues())[startB:endB]
-    for i,((t1,t2),(q1,q2)) in enumerate(zip(*alignments[0].aligned)):
-        for j, (residueA, residueB) in enumerate(zip(residuesA[t1:t2], residuesB[q1:q2])):
-            if residueA.resname != residueB.resname:
-                print(f'WARNING: Residues {residueA.resname} and {residueB.resname} don\'t match at position: {j}')
-            try:
-                atomA = residueA['CA']
-                atomB = residueB['CA']
-            except KeyError:
-                print(f'WARNING: Atom "CA" missing at position: {i}')
-                continue
-            if atomB is None or atomA is None:
-                print(f'WARNING: Atom "CA" missing at position: {i}')
-                continue
-            atomsA.append(atomA)
-            atomsB.append(atomB)
-    return atomsA, atomsB
+        print(alignment)
+
+    idxA = []
+    idxB = []
+    lenA = len(seqA[startA:endA])
+    lenB = len(seqB[startB:endB])
+    for i,((t1,t2),(q1,q2)) in enumerate(zip(*alignment.aligned)):
+        n = min(t2, lenA) - t1
+        n = min(n, min(q2, lenB) - q1)
+        a = np.arange(startA + t1, startA + t1 + n)
+        b = np.arange(startB + q1, startB + q1 + n)
+        for j in np.flatnonzero(resnamesA[a] != resnamesB[b]):
+            print(f'WARNING: Residues {resnamesA[a[j]]} and {resnamesB[b[j]]} don\'t match at position: {j}')
+        present = ~np.isnan(caA[a,0]) & ~np.isnan(caB[b,0])
+        for _ in range((~present).sum()):
+            print(f'WARNING: Atom "CA" missing at position: {i}')
+        idxA.append(a[present])
+        idxB.append(b[present])
+    idxA = np.concatenate(idxA + [np.array([], dtype=int)])
+    idxB = np.concatenate(idxB + [np.array([], dtype=int)])
+    return idxA, idxB
+
+GDT_THRESHOLDS = [1, 2, 4, 8]
+
+def superimpose_batch(ref, models):
+    # Kabsch superposition of a stack of models onto one reference, with batched SVD
+    # ref (L, 3) and models (M, L, 3) are CA coordinates on the reference's residues, nan where missing or unaligned
+    # Returns the (M, L) distances to the reference after superposition, nan where masked
+    mask = ~np.isnan(models[:,:,0]) & ~np.isnan(ref[None,:,0])
+    w = mask[:,:,None]
+    n = np.maximum(mask.sum(axis=1), 1)[:,None,None]
+    X = np.where(w, models, 0.)
+    Y = np.where(w, ref[None], 0.)
+    X = np.where(w, X - X.sum(axis=1, keepdims=True) / n, 0.)
+    Y = np.where(w, Y - Y.sum(axis=1, keepdims=True) / n, 0.)
+
+    U, _, Vt = np.linalg.svd(X.transpose(0,2,1) @ Y)
+    # avoid reflections
+    d = np.sign(np.linalg.det(U @ Vt))
+    U[:,:,2] *= np.where(d == 0, 1, d)[:,None]
+    dist = np.linalg.norm(X @ (U @ Vt) - Y, axis=2)
+    dist[~mask] = np.nan
+    return dist
+
+def compute_rmsd_gdt_batch(ref, models, thresholds=GDT_THRESHOLDS):
+    # RMSD (M,), number of superimposed residues (M,) and fraction of residues within each threshold (M, T)
+    # for every model, same as compute_rmsd and compute_gdt (one global superposition)
+    dist = superimpose_batch(ref, models)
+    n = (~np.isnan(dist)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmsd = np.sqrt(np.nansum(dist**2, axis=1) / n)
+        fractions = np.stack([(dist <= t).sum(axis=1) / n for t in thresholds], axis=1)
+    return rmsd, n, fractions
+
+GDT_HA_THRESHOLDS = [0.5, 1, 2, 4]
+GDT_ALL_THRESHOLDS = [0.5, 1, 2, 4, 8]
+
+def superimpose_subsets(ref, model, subsets):
+    # ref and model (n, 3) aligned CA coordinates, subsets (S, n) boolean masks
+    # Superimposes model onto ref once per subset (fitting only the subset's residues, batched over subsets)
+    # and returns the (S, n) distances of all residues
+    model = model - model.mean(axis=0)
+    ref = ref - ref.mean(axis=0)
+    w = subsets.astype(float)
+    k = np.maximum(w.sum(axis=1), 1)[:,None]
+    cX = w @ model / k
+    cY = w @ ref / k
+    # per-residue outer products - the weighted covariance of every subset is a single product with them
+    P = (model[:,:,None] * ref[:,None,:]).reshape(-1, 9)
+    H = (w @ P).reshape(-1, 3, 3) - k[:,:,None] * cX[:,:,None] * cY[:,None,:]
+    U, _, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(U @ Vt))
+    U[:,:,2] *= np.where(d == 0, 1, d)[:,None]
+    R = U @ Vt
+
+    # |(x - cX) R - (y - cY)|^2 expanded, so that all terms are (S, n) matrix products
+    RcY = (R @ cY[:,:,None])[:,:,0]
+    cXR = (cX[:,None,:] @ R)[:,0,:]
+    cross = (R.reshape(-1, 9) @ P.T) - RcY @ model.T - cXR @ ref.T + (cXR * cY).sum(axis=1)[:,None]
+    sqX = (model**2).sum(axis=1)[None] - 2 * cX @ model.T + (cX**2).sum(axis=1)[:,None]
+    sqY = (ref**2).sum(axis=1)[None] - 2 * cY @ ref.T + (cY**2).sum(axis=1)[:,None]
+    return np.sqrt(np.maximum(sqX + sqY - 2 * cross, 0))
+
+def get_seed_subsets(n, min_seed=4):
+    # Contiguous seed segments of lengths n, n/2, n/4, ... down to min_seed, at every start position
+    seeds = []
+    l = n
+    while l >= min(min_seed, n):
+        starts = np.arange(n - l + 1)
+        seeds.append((np.arange(n)[None] >= starts[:,None]) & (np.arange(n)[None] < starts[:,None] + l))
+        if l == min(min_seed, n):
+            break
+        l = max(l // 2, min(min_seed, n))
+    return np.concatenate(seeds)
+
+def compute_gdt_counts(ref, model, thresholds=GDT_THRESHOLDS, min_seed=4, max_iter=20, max_subsets=128):
+    # Largest number of residues within each distance threshold over superpositions found by iterative
+    # subset search (as in LGA): each seed segment is superimposed, then refit on the residues it brings
+    # within the threshold until the set stops changing; all seeds of an iteration are fit together
+    # Only the max_subsets largest sets are extended in each iteration (None to extend all of them)
+    # ref and model are (n, 3) aligned CA coordinates
+    n = ref.shape[0]
+    counts = np.zeros(len(thresholds), dtype=int)
+    if n < 3:
+        return counts
+    seeds = get_seed_subsets(n, min_seed)
+    # the seeds' superpositions do not depend on the threshold, so they are only fit once
+    seed_dist = superimpose_subsets(ref, model, seeds)
+    # thresholds in increasing order - the best sets within a threshold also seed the next one
+    order = np.argsort(thresholds)
+    best_subsets = np.zeros((0, n), dtype=bool)
+    for k,i in enumerate(order):
+        t = thresholds[i]
+        subsets = np.concatenate([seeds, best_subsets])
+        within = np.concatenate([seed_dist, superimpose_subsets(ref, model, best_subsets)]) <= t
+        for _ in range(max_iter):
+            n_within = within.sum(axis=1)
+            if n_within.max() > counts[i]:
+                counts[i] = n_within.max()
+                best_subsets = within[n_within == n_within.max()]
+            if counts[i] == n:
+                break
+            # only keep extending subsets that changed and still have enough residues to fit, once each
+            changed = (within != subsets).any(axis=1) & (n_within >= 3)
+            if not changed.any():
+                break
+            subsets = within[changed]
+            _, first = np.unique(np.packbits(subsets, axis=1), axis=0, return_index=True)
+            subsets = subsets[first]
+            if max_subsets is not None and subsets.shape[0] > max_subsets:
+                subsets = subsets[np.argsort(-subsets.sum(axis=1), kind='stable')[:max_subsets]]
+            within = superimpose_subsets(ref, model, subsets) <= t
+        if counts[i] == n:
+            # early termination - every residue is within all larger thresholds too
+            counts[order[k:]] = n
+            break
+    return counts
+
+def compute_gdt_scores_batch(ref, models, thresholds=GDT_ALL_THRESHOLDS, min_seed=4, max_iter=20, max_subsets=128):
+    # Fraction of the reference's residues within each threshold (M, T) for a stack of models laid out
+    # like superimpose_batch's, using compute_gdt_counts; GDT_TS and GDT_HA are means of these fractions
+    n_ref = (~np.isnan(ref[:,0])).sum()
+    fractions = np.full((models.shape[0], len(thresholds)), np.nan)
+    for m in range(models.shape[0]):
+        mask = ~np.isnan(models[m,:,0]) & ~np.isnan(ref[:,0])
+        if mask.sum() == 0:
+            continue
+        fractions[m] = compute_gdt_counts(ref[mask], models[m][mask], thresholds, min_seed, max_iter, max_subsets) / n_ref
+    return fractions
+
+def get_aligned_stack(fn_ref, fns, print_alignment=False):
+    # Reference CA coordinates (L, 3) and each model's aligned CA coordinates on the reference's residues (M, L, 3)
+    _, _, ref = get_structure_ca(fn_ref)
+    models = np.full((len(fns), ref.shape[0], 3), np.nan)
+    for i,fn in enumerate(fns):
+        try:
+            idx_ref, idx = get_aligned_indices(fn_ref, fn, print_alignment=print_alignment)
+        except Exception as e:
+            print(f'Error aligning {Path(fn).name}: {type(e).__name__}: {e}')
+            continue
+        models[i, idx_ref] = get_structure_ca(fn)[2][idx]
+    return ref, models
+
+def compute_rmsd_gdt_all(fn_ref, fns, print_alignment=False, method='iterative'):
+    # RMSD and GDT of many models against one reference structure, in the layout of the CASP results tables
+    # (Model is the file name, GDT scores are percentages); models that could not be aligned get nan
+    # method 'iterative' searches superpositions per threshold (compute_gdt_scores_batch) and adds GDT_HA,
+    # 'global' counts residues after the single RMSD superposition, like compute_gdt
+    ref, models = get_aligned_stack(fn_ref, fns, print_alignment)
+    rmsd, n, fractions = compute_rmsd_gdt_batch(ref, models)
+    thresholds = GDT_THRESHOLDS
+    if method == 'iterative':
+        thresholds = GDT_ALL_THRESHOLDS
+        fractions = compute_gdt_scores_batch(ref, models, thresholds)
+    elif method != 'global':
+        print(f'Unknown GDT method: {method}')
+        return None
+    results = pd.DataFrame(fractions * 100, columns=[f'GDT_P{t}' for t in thresholds])
+    results.insert(0, 'Model', [Path(fn).name for fn in fns])
+    results['GDT_TS'] = results[[f'GDT_P{t}' for t in GDT_THRESHOLDS]].mean(axis=1)
+    if method == 'iterative':
+        results['GDT_HA'] = results[[f'GDT_P{t}' for t in GDT_HA_THRESHOLDS]].mean(axis=1)
+    results['RMS_CA'] = rmsd
+    results['N'] = n
+    return results
+
+def compute_segment_rmsds(ref, model, subsets):
+    # ref and model (n, 3) aligned CA coordinates, subsets (S, n) boolean masks of the segments
+    # Superimposes each segment on its own, all in one batched pass, and returns per segment
+    # the RMSD, number of residues and sum of squared distances after superposition
+    dist = superimpose_subsets(ref, model, subsets)
+    n = subsets.sum(axis=1)
+    sq = (dist**2 * subsets).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmsd = np.sqrt(sq / n)
+    return rmsd, n, sq
+
+def get_split_segments(idxA, idxB, split):
+    # Segment masks of aligned residue pairs for split points given as positions or (posA, posB) tuples, where
+    # segments run up to (and exclude) each split point and the next one starts after it; segments narrower
+    # than 2 residues are skipped, like in DihedralAdherence.split_and_compute_rmsd
+    bounds = []
+    prev = (0,0)
+    for s in sorted(split):
+        if not isinstance(s, tuple):
+            s = (s,s)
+        if s[0] - prev[0] >= 2 and s[1] - prev[1] >= 2:
+            bounds.append((prev, s))
+        prev = (s[0] + 1, s[1] + 1)
+    bounds.append((prev, (np.inf, np.inf)))
+    subsets = np.array([
+        (idxA >= a[0]) & (idxA < b[0]) & (idxB >= a[1]) & (idxB < b[1]) for a,b in bounds
+    ]).reshape(len(bounds), len(idxA))
+    return bounds, subsets
+
+def compute_rmsd_segments(fnA, fnB, split, print_alignment=False):
+    # RMSD of each segment between split points, from a single alignment of the full structures
+    # Returns the segment bounds ((startA, startB), (endA, endB)) and per segment RMSD, counts and squared sums
+    idxA, idxB = get_aligned_indices(fnA, fnB, print_alignment=print_alignment)
+    bounds, subsets = get_split_segments(idxA, idxB, split)
+    rmsd, n, sq = compute_segment_rmsds(get_structure_ca(fnA)[2][idxA], get_structure_ca(fnB)[2][idxB], subsets)
+    return bounds, rmsd, n, sq
+
+def scan_split_rmsd(fnA, fnB, min_size=10, print_alignment=False):
+    # RMSD of the two halves for every single split point of the aligned residues (e.g. to find domain
+    # boundaries) - both halves of all split points are superimposed in one batched pass
+    idxA, idxB = get_aligned_indices(fnA, fnB, print_alignment=print_alignment)
+    coordsA, coordsB = get_structure_ca(fnA)[2][idxA], get_structure_ca(fnB)[2][idxB]
+    m = len(idxA)
+    points = np.arange(min_size, m - min_size)
+    if len(points) == 0:
+        print(f'Not enough aligned residues ({m}) to split with min_size={min_size}')
+        return None
+    pos = np.arange(m)[None]
+    subsets = np.concatenate([pos < points[:,None], pos > points[:,None]])
+    rmsd, n, sq = compute_segment_rmsds(coordsA, coordsB, subsets)
+    k = len(points)
+    return pd.DataFrame({
+        'split': idxA[points],
+        'split_pred': idxB[points],
+        'rmsd_1': rmsd[:k],
+        'rmsd_2': rmsd[k:],
+        'n_1': n[:k],
+        'n_2': n[k:],
+        'rmsd_total': np.sqrt((sq[:k] + sq[k:]) / (n[:k] + n[k:])),
+    })
+
+# rmsd/gdt results keyed by content hashes, least recently used evicted first
+STRUCTURE_METRICS_CACHE_SIZE = 65536
+_structure_metrics = OrderedDict()
+
+def hash_structure_data(data):
+    # Hash of the atom records of a PDB file's first model - names, residues, chains and coordinates -
+    # ignoring headers, atom serials, occupancies and b-factors, so identical models resubmitted under
+    # different names (or with different formatting) hash the same
+    h = hashlib.sha1()
+    for line in data.splitlines():
+        if line.startswith(b'ENDMDL'):
+            break
+        if not line.startswith((b'ATOM', b'HETATM')):
+            continue
+        try:
+            coords = b'%.3f %.3f %.3f' % (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+        except ValueError:
+            coords = line[30:54]
+        h.update(line[:6] + line[12:27] + coords + b'\n')
+    return h.hexdigest()
+
+@lru_cache(maxsize=4096)
+def load_structure_hash(fn, mtime_ns, size):
+    return hash_structure_data(read_prediction(fn))
+
+def get_structure_hash(fn, data=None):
+    # Cached by path, modification time and size (models of a tarball are keyed by the tarball's stat)
+    # data are the file's contents, if already read
+    if data is not None:
+        return hash_structure_data(data)
+    stat = os.stat(get_tarball(fn) or fn)
+    return load_structure_hash(str(fn), stat.st_mtime_ns, stat.st_size)
+
+def get_structure_metric(key, compute, use_cache=True):
+    if use_cache and key in _structure_metrics:
+        _structure_metrics.move_to_end(key)
+        return _structure_metrics[key]
+    _structure_metrics[key] = compute()
+    _structure_metrics.move_to_end(key)
+    if len(_structure_metrics) > STRUCTURE_METRICS_CACHE_SIZE:
+        _structure_metrics.popitem(last=False)
+    return _structure_metrics[key]
+
+def clear_structure_caches():
+    # Drop parsed structures, hashes, alignments and rmsd/gdt results, e.g. between targets
+    load_structure_ca.cache_clear()
+    load_structure_hash.cache_clear()
+    get_alignment.cache_clear()
+    _structure_metrics.clear()
+
+def group_identical_structures(fns, data=None):
+    # For each file, the first file with the same structure content (itself if it is the first)
+    # data optionally maps files to their contents, if already read
+    first = {}
+    return [first.setdefault(get_structure_hash(fn, None if data is None else data[fn]), fn) for fn in fns]
 
 def compute_rmsd(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True, return_n=False):
-    atomsA, atomsB = get_aligned_atoms(fnA, fnB, startA, endA, startB, endB, print_alignment)
+    # Identical structures (by content) are only superimposed once - unless the alignment should be printed
+    key = ('rmsd', get_structure_hash(fnA), get_structure_hash(fnB), startA, endA, startB, endB, return_n)
+    return get_structure_metric(
+        key, lambda: compute_rmsd_(fnA, fnB, startA, endA, startB, endB, print_alignment, return_n), not print_alignment
+    )
+
+def compute_rmsd_(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True, return_n=False):
+    coordsA, coordsB = get_aligned_coords(fnA, fnB, startA, endA, startB, endB, print_alignment)
 
-    sup = Superimposer()
-    sup.set_atoms(atomsA, atomsB)
-    sup.apply(atomsB)
+    sup = SVDSuperimposer()
+    sup.set(coordsA, coordsB)
+    sup.run()
     if return_n:
-        atomsA = np.array([a.coord for a in atomsA])
-        atomsB = np.array([a.coord for a in atomsB])
-        dist = np.sum((atomsA - atomsB)**2)
-        return sup.rms, len(atomsA), dist
-    return sup.rms
+        dist = np.sum((coordsA - sup.get_transformed())**2)
+        return sup.get_rms(), len(coordsA), dist
+    return sup.get_rms()
 
 def compute_gdt(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True, return_n=False, thresholds=[1,2,4,8]):
-    # WARNING: This is not consistent with the GDT_TS calculation from CASP
-    atomsA, atomsB = get_aligned_atoms(fnA, fnB, startA, endA, startB, endB, print_alignment)
+    key = ('gdt', get_structure_hash(fnA), get_structure_hash(fnB), startA, endA, startB, endB, tuple(thresholds))
+    return get_structure_metric(
+        key, lambda: compute_gdt_(fnA, fnB, startA, endA, startB, endB, print_alignment, return_n, thresholds),
+        not print_alignment
+    )
+
+def compute_gdt_(fnA, fnB, startA=None, endA=None, startB=None, endB=None, print_alignment=True, return_n=False, thresholds=[1,2,4,8]):
+    # WARNING: This is not consistent with the GDT_TS calculation from CASP - see compute_gdt_counts
+    coordsA, coordsB = get_aligned_coords(fnA, fnB, startA, endA, startB, endB, print_alignment)
 
-    sup = Superimposer()
-    sup.set_atoms(atomsA, atomsB)
-    sup.apply(atomsB)
-    atomsA = np.array([a.coord for a in atomsA])
-    atomsB = np.array([a.coord for a in atomsB])
-    n = atomsA.shape[0]
+    sup = SVDSuperimposer()
+    sup.set(coordsA, coordsB)
+    sup.run()
+    n = coordsA.shape[0]
 
-    dist = np.linalg.norm(atomsA - atomsB, axis=1)
+    dist = np.linalg.norm(coordsA - sup.get_transformed(), axis=1)
     gdt = []
     for t in thresholds:
         gdt.append((dist <= t).sum() / n)
     return np.mean(gdt)
 
 def test_correlation(ins):
+    from scipy.stats import pearsonr, linregress
     grouped_preds = ins.grouped_preds.dropna(subset=['log_da', 'GDT_TS'])
     regr = linregress(grouped_preds.log_da, grouped_preds.GDT_TS)
     print(f'LinRegr - Slope: {regr.slope}, Intercept: {regr.intercept}', 'R-squared:', regr.rvalue**2, 'p-value:', regr.pvalue)
@@ -0,0 +1,53 @@
+###############################################
+# Author : Musa Azeem
+# Created: 2025-06-29
+###############################################
+
+import multiprocessing as mp
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+# Per-worker state, set once by _init_worker
+_state = {}
+
+def get_match_arrays(ins):
+    return [(q.winsize, q.weight, *q.get_match_arrays()) for q in ins.queries]
+
+def run_over_residues(ins, func, tasks, n_jobs=1, blas_threads=1):
+    # Run func(match_arrays, winsize_ctxt, *task) for every task and return the results in order
+    # With n_jobs > 1, the match arrays are written once to .npy files that every worker
+    # memory-maps, so workers share them through the page cache instead of receiving copies
+    match_arrays = get_match_arrays(ins)
+    if n_jobs == 1 or len(tasks) <= 1:
+        return [func(match_arrays, ins.winsize_ctxt, *task) for task in tasks]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        match_files = []
+        for k, (winsize, weight, matches, seq_rows) in enumerate(match_arrays):
+            fn = Path(tmpdir) / f'matches_{k}.npy'
+            np.save(fn, matches)
+            match_files.append((winsize, weight, str(fn), seq_rows))
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, 
+            mp_context=mp.get_context('spawn'),
+            initializer=_init_worker, 
+            initargs=(match_files, ins.winsize_ctxt, blas_threads)
+        ) as executor:
+            chunksize = max(1, len(tasks) // (n_jobs * 4))
+            return list(executor.map(_run_task, [(func, task) for task in tasks], chunksize=chunksize))
+
+def _init_worker(match_files, winsize_ctxt, blas_threads):
+    # limit BLAS/OpenMP threads so n_jobs workers don't oversubscribe the cores
+    _state['limits'] = threadpool_limits(blas_threads)
+    _state['match_arrays'] = [
+        (winsize, weight, np.load(fn, mmap_mode='r'), seq_rows)
+        for winsize, weight, fn, seq_rows in match_files
+    ]
+    _state['winsize_ctxt'] = winsize_ctxt
+
+def _run_task(args):
+    func, task = args
+    return func(_state['match_arrays'], _state['winsize_ctxt'], *task)